@@ -0,0 +1,369 @@
+"""
+Offline load test of run.py
+
+Run from anywhere, only ffmpeg is needed:
+
+`python3 benchmarks/loadtest.py [--clients N] [--jobs N] [--mix toMP3,playlist,clip,combine,subtitles] [--out results.json] [--compare old.json]`
+
+Media files are generated with ffmpeg and served by a local http server, run.py is started in its own process
+with a fake yt-dlp extractor in front of the real ones that answers for youtube urls with those files,
+so nothing leaves the machine. Every client is a socket.io connection that sends its jobs one after the other
+and waits for each done event. The results have the p50/p95/p99 latency per event, jobs per second,
+the peak RSS of the server process and the lag of its event loop, and are written as JSON.
+With --compare the results are checked against an earlier run, e.g. of another version
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+methods = ("toMP3", "playlist", "clip", "combine", "subtitles")
+""" Events the load test can send """
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values: list[float], p: float) -> float|None:
+    """
+    Nearest rank percentile p (0-100) of values
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))]
+
+def summary(values: list[float]) -> dict[str]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values, default=None)
+    }
+
+def makeMedia(path: str, duration: int):
+    """
+    Generate the media the fake extractor hands out: a video with audio, the video and audio alone and subtitles
+    """
+    ffmpeg = ["ffmpeg", "-y", "-v", "error"]
+    subprocess.run(ffmpeg + [
+        "-f", "lavfi", "-i", f"testsrc=size=640x360:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", "60", "-c:a", "aac", "-movflags", "+faststart",
+        os.path.join(path, "av.mp4")
+    ], check=True)
+    subprocess.run(ffmpeg + ["-i", os.path.join(path, "av.mp4"), "-an", "-c", "copy", "-movflags", "+faststart", os.path.join(path, "v.mp4")], check=True)
+    subprocess.run(ffmpeg + ["-i", os.path.join(path, "av.mp4"), "-vn", "-c", "copy", os.path.join(path, "a.m4a")], check=True)
+    with open(os.path.join(path, "en.vtt"), "w") as f:
+        f.write("WEBVTT\n\n")
+        for i in range(duration):
+            f.write(f"00:00:{i:02d}.000 --> 00:00:{i:02d}.900\nLine {i}\n\n")
+
+def serveMedia(path: str, port: int):
+    """
+    Serve the media from path in a thread, with range requests like a real video host
+    """
+    import tornado.web
+    async def serve():
+        tornado.web.Application([(r"/(.*)", tornado.web.StaticFileHandler, {"path": path})]).listen(port, "127.0.0.1")
+        await asyncio.Event().wait()
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+
+def serve(media: str, duration: int, playlistLength: int):
+    """
+    Run run.py in this process with the fake extractor and a /bench route that reports the event loop lag
+    The working directory has to have the .conf.json for the test
+    """
+    sys.path.insert(0, repo)
+    import tornado.web
+    from yt_dlp import YoutubeDL
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class FakeIE(InfoExtractor):
+        """
+        Answers for youtube videos and playlists with the generated media
+        """
+        _VALID_URL = r"https?://(?:www\.)?youtube\.com/(?:watch\?v=|playlist\?list=)(?P<id>[\w-]+)"
+        IE_NAME = "bench"
+
+        def _real_extract(self, url):
+            vid = self._match_id(url)
+            if "list=" in url:
+                entries = [self.url_result(f"https://www.youtube.com/watch?v={vid}-{i}", FakeIE) for i in range(playlistLength)]
+                return self.playlist_result(entries, vid, f"Playlist {vid}")
+            formats = [
+                {"format_id": "a", "url": f"{media}/a.m4a", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2", "abr": 128, "protocol": "http"},
+                {"format_id": "v", "url": f"{media}/v.mp4", "ext": "mp4", "vcodec": "avc1.64001e", "acodec": "none", "height": 360, "protocol": "http"},
+                {"format_id": "av", "url": f"{media}/av.mp4", "ext": "mp4", "vcodec": "avc1.64001e", "acodec": "mp4a.40.2", "height": 360, "protocol": "http"}
+            ]
+            return {
+                "id": vid,
+                "title": f"Video {vid}",
+                "duration": duration,
+                "formats": formats,
+                "subtitles": {"en": [{"ext": "vtt", "url": f"{media}/en.vtt"}]}
+            }
+
+    addExtractors = YoutubeDL.add_default_info_extractors
+    def add_default_info_extractors(self):
+        # The fake extractor goes first so it's picked over the real youtube one
+        self.add_info_extractor(FakeIE())
+        addExtractors(self)
+    YoutubeDL.add_default_info_extractors = add_default_info_extractors
+
+    import run
+    lags = []
+    async def probe():
+        # A sleep that takes longer than asked for means the loop was busy
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(0.05)
+            lags.append(time.monotonic() - start - 0.05)
+    class BenchHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({"loopLag": summary(lags), "samples": len(lags)})
+    makeApp = run.make_app
+    def make_app():
+        app = makeApp()
+        app.add_handlers(r".*", [(r"/bench", BenchHandler)])
+        return app
+    run.make_app = make_app
+    async def main():
+        task = asyncio.create_task(probe())
+        await run.main()
+    asyncio.run(main())
+
+def payload(method: str, n: int, timeA: int) -> dict[str]:
+    """
+    Payload of job n for method
+    """
+    url = f"https://www.youtube.com/watch?v=v{n}"
+    if method == "toMP3":
+        return {"url": url, "id3": None}
+    if method == "playlist":
+        return {"url": f"https://www.youtube.com/playlist?list=p{n}"}
+    if method == "clip":
+        return {"url": url, "format_id": "av", "timeA": timeA, "timeB": timeA + 5}
+    if method == "combine":
+        return {"url": url, "format_id": "v", "format_id_audio": "a"}
+    return {"url": url, "step": 2, "languageCode": "en", "autoSub": False}
+
+def client(url: str, jobs: list[tuple[str, dict]], results: list, timeout: float):
+    """
+    Send jobs one after the other over one connection, recording (method, seconds, error, time finished) for each
+    """
+    import socketio
+    done = {}
+    transports = ["polling"]
+    try:
+        import websocket
+        transports.append("websocket")
+    except ImportError:
+        pass
+    sio = socketio.Client()
+    @sio.on("done")
+    def onDone(data):
+        event = done.get(data.get("spinnerid"))
+        if event != None:
+            event[1] = data
+            event[0].set()
+    sio.connect(url, transports=transports)
+    try:
+        for method, data in jobs:
+            spinnerid = random.getrandbits(48)
+            done[spinnerid] = [threading.Event(), None]
+            start = time.monotonic()
+            sio.emit(method, dict(data, spinnerid=spinnerid))
+            if done[spinnerid][0].wait(timeout):
+                res = done[spinnerid][1]
+                results.append((method, time.monotonic() - start, res.get("details") if res["error"] else None, time.monotonic()))
+            else:
+                results.append((method, time.monotonic() - start, "timeout", time.monotonic()))
+            del done[spinnerid]
+    finally:
+        sio.disconnect()
+
+def peakRSS(pid: int) -> int|None:
+    """
+    Peak resident set size of pid in bytes, Linux only
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def version() -> str|None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def loadtest(args) -> dict[str]:
+    work = tempfile.mkdtemp(prefix="yda-bench-")
+    server = None
+    try:
+        media = os.path.join(work, "media")
+        os.makedirs(media)
+        makeMedia(media, args.duration)
+        mediaPort = freePort()
+        serveMedia(media, mediaPort)
+        port = freePort()
+        with open(os.path.join(repo, ".conf.json.example")) as f:
+            conf = json.load(f)
+        conf.update({
+            "downloadsPath": os.path.join(work, "downloads"),
+            "url": f"http://127.0.0.1:{port}",
+            "listeningPort": port,
+            "proxyListURL": False,
+            "bugcatcher": False,
+            "jobQueue": False,
+            "maxLength": max(conf["maxLength"], args.duration),
+            "maxLengthPlaylistVideo": max(conf["maxLengthPlaylistVideo"], args.duration),
+            "maxPlaylistLength": max(conf["maxPlaylistLength"], args.playlist),
+            # The clients are all on localhost so the rate limit would only get in the way
+            "rateLimit": {"rate": 1000000, "burst": 1000000}
+        })
+        for setting in args.set:
+            key, value = setting.split("=", 1)
+            conf[key] = json.loads(value)
+        with open(os.path.join(work, ".conf.json"), "w") as f:
+            json.dump(conf, f)
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", f"http://127.0.0.1:{mediaPort}", "--duration", str(args.duration), "--playlist", str(args.playlist)],
+            cwd=work
+        )
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/bench", timeout=1)
+                break
+            except OSError:
+                if server.poll() != None or time.monotonic() > deadline:
+                    raise RuntimeError("Server didn't start")
+                time.sleep(0.2)
+        mix = args.mix.split(",")
+        rng = random.Random(args.seed)
+        n = 0
+        plans = []
+        for c in range(args.clients):
+            plan = []
+            for j in range(args.jobs):
+                # A share of the jobs repeat an earlier video to exercise the caches
+                vid = rng.randrange(max(1, n)) if n > 0 and rng.random() < args.repeat else n
+                n += 1
+                method = mix[(c + j) % len(mix)]
+                plan.append((method, payload(method, vid, rng.randrange(max(1, args.duration - 5)))))
+            plans.append(plan)
+        results = []
+        start = time.monotonic()
+        threads = [threading.Thread(target=client, args=(f"http://127.0.0.1:{port}", plan, results, args.timeout)) for plan in plans]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Disconnecting can wait for a long poll so the run ends with the last job
+        wall = max(r[3] for r in results) - start
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/bench") as r:
+            bench = json.load(r)
+        rss = peakRSS(server.pid)
+    finally:
+        if server != None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work, ignore_errors=True)
+    latency = {"all": summary([r[1] for r in results])}
+    latency["all"]["count"] = len(results)
+    latency["all"]["errors"] = sum(1 for r in results if r[2] != None)
+    for method in mix:
+        latency[method] = summary([r[1] for r in results if r[0] == method])
+        latency[method]["count"] = sum(1 for r in results if r[0] == method)
+        latency[method]["errors"] = sum(1 for r in results if r[0] == method and r[2] != None)
+    return {
+        "version": version(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "settings": {
+            "clients": args.clients,
+            "jobs": args.jobs,
+            "mix": mix,
+            "repeat": args.repeat,
+            "duration": args.duration,
+            "playlist": args.playlist,
+            "set": args.set
+        },
+        "wall": wall,
+        "jobsPerSecond": (len(results) - latency["all"]["errors"]) / wall,
+        "latency": latency,
+        "peakRSS": rss,
+        "loopLag": bench["loopLag"],
+        "errors": sorted(set(r[2] for r in results if r[2] != None))
+    }
+
+def compare(old: dict[str], new: dict[str], threshold: float) -> bool:
+    """
+    Print how new compares to old, returns False if anything got worse by more than threshold percent
+    """
+    ok = True
+    rows = [("jobsPerSecond", old.get("jobsPerSecond"), new.get("jobsPerSecond"), True), ("peakRSS", old.get("peakRSS"), new.get("peakRSS"), False)]
+    for p in ("p50", "p99", "max"):
+        rows.append((f"loopLag.{p}", old["loopLag"].get(p), new["loopLag"].get(p), False))
+    for method in new["latency"]:
+        for p in ("p50", "p95", "p99"):
+            rows.append((f"latency.{method}.{p}", old["latency"].get(method, {}).get(p), new["latency"][method].get(p), False))
+    print(f"{old.get('version')} -> {new.get('version')}")
+    for name, a, b, higherIsBetter in rows:
+        if a in (None, 0) or b == None:
+            continue
+        change = (b - a) / a * 100
+        worse = -change if higherIsBetter else change
+        flag = ""
+        if threshold != None and worse > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:32} {a:12.4g} {b:12.4g} {change:+7.1f}%{flag}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test of run.py")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent socket.io clients")
+    parser.add_argument("--jobs", type=int, default=5, help="number of jobs each client sends")
+    parser.add_argument("--mix", default=",".join(methods), help="comma separated events to send, clients cycle through them")
+    parser.add_argument("--repeat", type=float, default=0, help="share of jobs for a video that was already asked for")
+    parser.add_argument("--duration", type=int, default=30, help="length of the generated media in seconds")
+    parser.add_argument("--playlist", type=int, default=3, help="number of videos in a playlist")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for a job")
+    parser.add_argument("--seed", type=int, default=0, help="seed for picking the jobs")
+    parser.add_argument("--set", action="append", default=[], help="config override as key=json, can be given several times")
+    parser.add_argument("--out", help="file to write the results to")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=None, help="exit with an error if anything got worse by more than this percent")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve != None:
+        serve(args.serve, args.duration, args.playlist)
+        sys.exit()
+    results = loadtest(args)
+    print(json.dumps(results, indent=4))
+    if args.out != None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare != None:
+        with open(args.compare) as f:
+            if not compare(json.load(f), results, args.threshold):
+                sys.exit(1)
@@ -0,0 +1,72 @@
+"""
+Benchmark of startup time and per call YoutubeDL overhead
+
+Run from a directory with a .conf.json, e.g. the repository root:
+
+`python3 benchmarks/startup.py [--runs N] [--calls N] [--url URL]`
+
+Startup is the time to import run.py in a fresh interpreter, along with which of the heavy optional
+dependencies got loaded. Per call overhead compares building a new YoutubeDL for every call with
+taking one from ydlPool, with --url the info extraction of that url is timed both ways as well
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy = ("yt_dlp", "kombu", "mutagen", "pygifsicle", "moviepy", "numpy")
+""" Modules that are slow to import """
+
+probe = f"""
+import sys, time
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+import run
+print(time.perf_counter() - start)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+def startup(runs: int):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout.split("\n")
+        times.append((time.perf_counter() - start, float(out[0])))
+    print(f"startup: process {statistics.median(t[0] for t in times) * 1000:.0f}ms, import run {statistics.median(t[1] for t in times) * 1000:.0f}ms (median of {runs})")
+    print(f"heavy modules loaded: {out[1] or 'none'}")
+
+def timeCalls(name: str, calls: int, fn):
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    print(f"{name}: {statistics.median(times) * 1000:.2f}ms median, {statistics.mean(times) * 1000:.2f}ms mean ({calls} calls)")
+
+def overhead(calls: int, url: str|None):
+    sys.path.insert(0, repo)
+    import run
+    opts = {"quiet": True}
+    def fresh():
+        with run.YoutubeDL(opts) as ydl:
+            if url != None:
+                ydl.extract_info(url, download=False)
+    def pooled():
+        with run.ydlPool.get(opts) as ydl:
+            if url != None:
+                ydl.extract_info(url, download=False)
+    timeCalls("fresh YoutubeDL", calls, fresh)
+    timeCalls("pooled YoutubeDL", calls, pooled)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark startup time and per call YoutubeDL overhead")
+    parser.add_argument("--runs", type=int, default=5, help="number of startups to time")
+    parser.add_argument("--calls", type=int, default=50, help="number of YoutubeDL calls to time")
+    parser.add_argument("--url", default=None, help="url to extract on every call")
+    args = parser.parse_args()
+    startup(args.runs)
+    overhead(args.calls, args.url)
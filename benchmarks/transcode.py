@@ -0,0 +1,102 @@
+"""
+Benchmark of transcoding throughput with and without the ffmpeg thread budget
+
+Run from anywhere, only ffmpeg is needed:
+
+`python3 benchmarks/transcode.py [--jobs 1,4,16] [--duration N] [--size WxH] [--codec libx264] [--out results.json]`
+
+A test video is generated with ffmpeg and re-encoded by N jobs at the same time through run.py's convertStreams,
+the way combine converts videos, once with every ffmpeg using all cores and once with transcodeBudget sharing them.
+Throughput is the seconds of video encoded per second of wall time over all jobs, along with the mean and
+slowest job. The difference only shows on machines with several cores
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def makeVideo(path: str, duration: int, size: str):
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", path
+    ], check=True)
+
+def runLevel(run, source: str, work: str, jobs: int, duration: int, codec: str) -> dict[str]:
+    """
+    Encode source with jobs jobs at the same time
+    """
+    def job(i: int) -> float:
+        # Count as an active combine job like runTracked does so the budget sees the whole burst
+        run.activeJobs.inc(event="combine")
+        start = time.perf_counter()
+        try:
+            run.convertStreams(source, os.path.join(work, f"out{i}.mkv"), {"video": codec, "audio": "copy"}, duration)
+        finally:
+            run.activeJobs.dec(event="combine")
+        return time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        times = list(pool.map(job, range(jobs)))
+    wall = time.perf_counter() - start
+    return {
+        "jobs": jobs,
+        "wall": wall,
+        "throughput": jobs * duration / wall,
+        "meanJob": statistics.mean(times),
+        "maxJob": max(times)
+    }
+
+def benchmark(args) -> dict[str]:
+    work = tempfile.mkdtemp(prefix="yda-transcode-")
+    try:
+        source = os.path.join(work, "source.mp4")
+        makeVideo(source, args.duration, args.size)
+        with open(os.path.join(repo, ".conf.json.example")) as f:
+            conf = json.load(f)
+        conf.update({"downloadsPath": os.path.join(work, "downloads"), "proxyListURL": False, "bugcatcher": False, "jobQueue": False})
+        if args.cores > 0:
+            conf["transcodeBudget"] = dict(conf.get("transcodeBudget", {}), cores=args.cores)
+        with open(os.path.join(work, ".conf.json"), "w") as f:
+            json.dump(conf, f)
+        # run.py reads .conf.json from the working directory
+        os.chdir(work)
+        sys.path.insert(0, repo)
+        import run
+        results = {"cores": run.cpuBudget.cores, "codec": args.codec, "duration": args.duration, "size": args.size, "levels": []}
+        for jobs in args.jobs:
+            level = {}
+            for mode, enabled in (("unbudgeted", False), ("budgeted", True)):
+                run.cpuBudget.enabled = enabled
+                level[mode] = runLevel(run, source, work, jobs, args.duration, args.codec)
+                print(f"{jobs:>3} jobs {mode:>10}: {level[mode]['throughput']:.2f}s of video/s, mean job {level[mode]['meanJob']:.2f}s, slowest {level[mode]['maxJob']:.2f}s", file=sys.stderr)
+            level["speedup"] = level["budgeted"]["throughput"] / level["unbudgeted"]["throughput"]
+            results["levels"].append(dict(level, jobs=jobs))
+        return results
+    finally:
+        os.chdir(repo)
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transcoding throughput with and without the ffmpeg thread budget")
+    parser.add_argument("--jobs", type=lambda s: [int(n) for n in s.split(",")], default=[1, 4, 16], help="comma separated numbers of concurrent jobs")
+    parser.add_argument("--duration", type=int, default=10, help="length of the test video in seconds")
+    parser.add_argument("--size", default="1280x720", help="resolution of the test video")
+    parser.add_argument("--codec", default="libx264", help="ffmpeg video encoder to convert to")
+    parser.add_argument("--cores", type=int, default=0, help="cores the budget shares, defaults to all")
+    parser.add_argument("--out", default=None, help="file to write the results to as JSON")
+    args = parser.parse_args()
+    results = benchmark(args)
+    print(json.dumps(results, indent=4))
+    if args.out != None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
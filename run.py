@@ -3,20 +3,41 @@
 """
 import socketio
 from yt_dlp import YoutubeDL
+import yt_dlp.utils
+import yt_dlp.networking.exceptions
 import json
 import asyncio
 import tornado
+import tornado.web
 import requests
+import requests.adapters
+import urllib3
 import os
 import random
 import uuid
 import zipfile
-import datetime
 import sys
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
-from moviepy.editor import VideoFileClip
-from pygifsicle import optimize
-from mutagen.easyid3 import EasyID3
+import functools
+import heapq
+import itertools
+import math
+import contextvars
+import time
+import urllib.parse
+import contextlib
+import threading
+import subprocess
+import shutil
+import mimetypes
+import glob
+import ipaddress
+import traceback
+import re
+import sqlite3
+import socket
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import sentry_sdk
 from sentry_sdk import capture_exception
 
@@ -43,12 +64,120 @@ with open(confpath, "r") as f:
 if conf["bugcatcher"]:
     sentry_sdk.init(conf["bugcatcherdsn"])
 
+class ProxyPool:
+    """
+    Proxies from the proxy list kept in memory along with how well they work
+    Proxies are picked at random weighted by their success rate and latency, proxies that get rate limited
+    or time out are quarantined for proxyQuarantine seconds, doubling each time it happens again in a row
+    All methods are thread safe
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proxies: list[str] = []
+        # proxy -> {"latency": moving average in seconds, "failures": moving average failure rate,
+        # "uses": number of reports, "quarantined": time the quarantine ends, "strikes": quarantines in a row}
+        self.health: dict[str, dict] = {}
+
+    def load(self, path: str="proxies.txt"):
+        """
+        Replace the proxies with the ones in path, health is kept for proxies that are still on the list
+        """
+        with open(path, "r") as f:
+            proxies = [p for p in f.read().split("\n") if p.strip() != ""]
+        with self.lock:
+            self.proxies = proxies
+            self.health = {p: self.health.get(p, {"latency": None, "failures": 0.0, "uses": 0, "quarantined": 0.0, "strikes": 0}) for p in proxies}
+
+    def pick(self) -> str:
+        """
+        Pick a proxy, preferring fast and healthy ones
+        """
+        with self.lock:
+            if len(self.proxies) == 0:
+                raise ValueError("No proxies available")
+            now = time.time()
+            available = [p for p in self.proxies if self.health[p]["quarantined"] <= now]
+            # If everything is quarantined there's nothing better to do than try any of them
+            if len(available) == 0:
+                return random.choice(self.proxies)
+            # Proxies without a latency yet get the average so they get tried
+            known = [self.health[p]["latency"] for p in available if self.health[p]["latency"] != None]
+            default = sum(known) / len(known) if len(known) > 0 else 1.0
+            weights = []
+            for p in available:
+                h = self.health[p]
+                latency = h["latency"] if h["latency"] != None else default
+                weights.append(max(1 - h["failures"], 0.05) / max(latency, 0.05))
+            return random.choices(available, weights)[0]
+
+    def report(self, proxy: str|None, ok: bool, latency: float|None = None, quarantine: bool = False):
+        """
+        Record the outcome of a request through proxy, latency in seconds if known
+        quarantine takes the proxy out of rotation for a while, for rate limits and timeouts
+        """
+        if proxy == None:
+            return
+        with self.lock:
+            h = self.health.get(proxy)
+            if h == None:
+                return
+            h["uses"] += 1
+            h["failures"] = 0.8 * h["failures"] + (0.0 if ok else 0.2)
+            if latency != None:
+                h["latency"] = latency if h["latency"] == None else 0.7 * h["latency"] + 0.3 * latency
+            if quarantine:
+                h["strikes"] += 1
+                h["quarantined"] = time.time() + conf.get("proxyQuarantine", 300) * 2 ** (h["strikes"] - 1)
+            elif ok:
+                h["strikes"] = 0
+
+    def reportError(self, proxy: str|None, e: Exception):
+        """
+        Record a failed request through proxy, working out from the error whether the proxy is to blame
+        """
+        msg = str(e).lower()
+        if "429" in msg or "too many requests" in msg or "timed out" in msg or isinstance(e, (requests.Timeout, socket.timeout)):
+            self.report(proxy, False, quarantine=True)
+        elif isinstance(e, (requests.ConnectionError, ConnectionError)) or "proxy" in msg or "connection" in msg:
+            self.report(proxy, False)
+
+    @contextlib.contextmanager
+    def using(self, proxy: str|None, timed: bool = True):
+        """
+        Context manager recording the outcome of the requests made in it through proxy
+        If timed the time taken counts as the latency of the proxy
+        """
+        start = time.monotonic()
+        try:
+            yield proxy
+        except Exception as e:
+            self.reportError(proxy, e)
+            raise
+        self.report(proxy, True, time.monotonic() - start if timed else None)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the number of proxies in the pool and how many of them are quarantined
+        The proxies themselves aren't included, stats can be read by any client
+        """
+        with self.lock:
+            now = time.time()
+            return {
+                "proxies": len(self.proxies),
+                "quarantined": sum(1 for h in self.health.values() if h["quarantined"] > now)
+            }
+
+proxyPool = ProxyPool()
+""" Pool of proxies from the proxy list """
+
 def dlProxies(path="proxies.txt"):
     """
     Function to download proxies from plain url to a given path. this is useful for me, but if other people need to utilize a more complex method of downloading proxies I recommend implementing it and doing a merge request
+    The file is replaced atomically and the proxies are loaded into the proxy pool
     """
-    r = requests.get(conf["proxyListURL"])
-    with open(path, "w") as f:
+    r = requests.get(conf["proxyListURL"], timeout=60)
+    r.raise_for_status()
+    with open(f"{path}.tmp", "w") as f:
         rlist = r.text.split("\n")
         rlistfixed = []
         for p in rlist[:-1]:
@@ -56,12 +185,1002 @@ def dlProxies(path="proxies.txt"):
             proxy = "{0}:{1}@{2}:{3}".format(pl[2], pl[3], pl[0], pl[1])
             rlistfixed.append(proxy)
         f.write("\n".join(rlistfixed))
+    os.replace(f"{path}.tmp", path)
+    proxyPool.load(path)
     print("Proxies refreshed!")
 
-# If using proxy list url and there's no proxies file, download proxies at runtime
+# If using proxy list url and there's no proxies file, download proxies at runtime, otherwise load the existing ones
 if conf["proxyListURL"] != False:
     if not os.path.exists("proxies.txt"):
         dlProxies()
+    else:
+        proxyPool.load()
+
+# Worker pools for blocking work, one per job type so that slow transcodes can't starve extraction
+# extract: network bound yt-dlp info extraction
+# download: network bound downloads
+# transcode: CPU bound ffmpeg work, defaults to one worker per core
+# Pool sizes can be overridden with the workers section of the config
+poolSizes: dict[str, int] = {
+    "extract": 8,
+    "download": 8,
+    "transcode": os.cpu_count() or 1
+}
+poolSizes.update(conf.get("workers", {}))
+pools: dict[str, ThreadPoolExecutor] = {
+    kind: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"yda-{kind}") for kind, size in poolSizes.items()
+}
+""" Thread pools per job type, used via runJob """
+
+async def runJob(kind: str, fn, *args, **kwargs):
+    """
+    Run the blocking function fn in the worker pool for the given job type and wait for the result without blocking the event loop
+    Threads are enough here as yt-dlp is network bound and ffmpeg runs as a separate process
+    The context is copied into the worker so metrics know which event the work belongs to
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pools[kind], functools.partial(contextvars.copy_context().run, runInThread, fn, *args, **kwargs))
+
+threadJobs: dict[int, str] = {}
+""" Worker thread id -> job it's currently working for, used by the profiler """
+
+def runInThread(fn, *args, **kwargs):
+    """
+    Run fn in a worker thread, recording which job the thread works for
+    """
+    ident = threading.get_ident()
+    owner = currentJob.get()
+    if owner != None:
+        threadJobs[ident] = owner
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        threadJobs.pop(ident, None)
+
+class Metric:
+    """
+    Prometheus style metric with labels, safe to update from any thread
+    If fn is given it's called when the metrics are rendered and returns a dict of label value tuples to values
+    """
+    def __init__(self, name: str, help: str, kind: str, labels: tuple[str, ...] = (), fn=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+        metrics.append(self)
+
+    def key(self, labels: dict[str]) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def labelText(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra != "":
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.fn() if self.fn != None else self.values
+        with self.lock:
+            for key, value in sorted(values.items()):
+                lines.append(f"{self.name}{self.labelText(key)} {value}")
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, "counter", labels)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), fn=None):
+        super().__init__(name, help, "gauge", labels, fn)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)):
+        super().__init__(name, help, "histogram", labels)
+        self.buckets = buckets
+        # key -> (bucket counts, sum, count)
+        self.observations: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.observations.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.observations[key] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.observations.items()):
+                for bound, bcount in zip(self.buckets, counts):
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{self.labelText(key, le)} {bcount}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{self.labelText(key, le)} {count}")
+                lines.append(f"{self.name}_sum{self.labelText(key)} {total}")
+                lines.append(f"{self.name}_count{self.labelText(key)} {count}")
+        return lines
+
+metrics: list[Metric] = []
+""" All metrics, rendered by the /metrics route """
+
+currentEvent: contextvars.ContextVar[str] = contextvars.ContextVar("currentEvent", default="none")
+""" Name of the event the current code runs for, used to label metrics """
+
+stageSeconds = Histogram("yda_stage_seconds", "Time spent in each stage of handling an event", ("event", "stage"))
+jobSeconds = Histogram("yda_job_seconds", "Time to handle an event from start to finish", ("event",))
+activeJobs = Gauge("yda_active_jobs", "Events currently being handled", ("event",))
+bytesServed = Counter("yda_bytes_served_total", "Bytes of artifacts sent to clients", ("route",))
+cleanedFiles = Counter("yda_cleaned_files_total", "Files removed from downloadsPath")
+cleanedBytes = Counter("yda_cleaned_bytes_total", "Bytes removed from downloadsPath")
+poolQueueDepth = Gauge(
+    "yda_pool_queue_depth", "Blocking calls waiting for a worker thread", ("pool",),
+    fn=lambda: {(kind,): pool._work_queue.qsize() for kind, pool in pools.items()}
+)
+
+diskUsage = Gauge("yda_downloads_bytes", "Bytes of the files tracked in downloadsPath", fn=lambda: {(): artifacts.total})
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """
+    Context manager recording how long the code in it takes as stage of the current event
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        stageSeconds.observe(time.monotonic() - start, event=currentEvent.get(), stage=stage)
+
+def renderMetrics() -> str:
+    """
+    Render all metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+# Query parameters that don't change what yt-dlp extracts, stripped when normalizing urls for caching
+trackingParams = {"si", "feature", "fbclid", "gclid", "pp"}
+
+def normalizeURL(url: str) -> str:
+    """
+    Normalize url for use as a cache key
+    Lowercases the scheme and host, drops the fragment and tracking parameters and sorts the query
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    query = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if k not in trackingParams and not k.startswith("utm_")
+    )
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urllib.parse.urlencode(query), ""))
+
+class InfoCache:
+    """
+    Cache for getInfo results keyed by normalized url and subtitle flag
+    Entries expire after ttl seconds and the least recently used entry is evicted once there are more than size entries
+    Concurrent requests for the same key wait on a single extraction instead of starting their own
+    """
+    def __init__(self, size: int=256, ttl: int=600):
+        self.size = size
+        self.ttl = ttl
+        # key -> (time of extraction, info), ordered from least to most recently used
+        self.entries: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+        # key -> future of an extraction that is currently running
+        self.inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, url: str, getSubtitles: bool=False) -> dict:
+        """
+        Get info for url from the cache, extracting it in the extract pool if it isn't cached
+        The returned info is shared between callers so it must not be modified
+        """
+        key = (normalizeURL(url), getSubtitles)
+        entry = self.entries.get(key)
+        if entry != None:
+            if time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        # If someone is already extracting this url wait for their result
+        if key in self.inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self.inflight[key])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            info = await retryJob("extract", getInfo, url, getSubtitles=getSubtitles)
+        except Exception as e:
+            # Errors are passed on to anyone waiting but not cached
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody was waiting
+            future.exception()
+            raise
+        except asyncio.CancelledError:
+            # Anyone waiting fails instead of hanging when the extraction is cancelled
+            future.set_exception(RuntimeError("Getting the video information was cancelled"))
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        future.set_result(info)
+        self.entries[key] = (time.monotonic(), info)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return info
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get hit/miss counts and current size of the cache
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self.entries),
+            "size": self.size
+        }
+
+infoCache = InfoCache(**conf.get("infoCache", {}))
+""" Cache for video information, configurable with the infoCache section of the config """
+
+def resultKey(info: dict, **params) -> tuple:
+    """
+    Build the result cache key for the video described by info and the parameters of the conversion,
+    e.g. format_id, format_id_audio, codec, quality and clip range
+    Parameters that aren't set are left out so that False and None are equivalent
+    """
+    vid = (info.get("extractor_key", info.get("ie_key")), info["id"])
+    return vid + tuple(sorted((k, json.dumps(v, sort_keys=True)) for k, v in params.items() if v not in (None, False)))
+
+currentJob: contextvars.ContextVar[str|None] = contextvars.ContextVar("currentJob", default=None)
+""" Id of the job the current code runs for, owns the artifacts it makes """
+
+def jobId() -> str|None:
+    """
+    Get the job id of the current job, without the event name
+    """
+    owner = currentJob.get()
+    if owner == None:
+        return None
+    return owner.split(":", 1)[1]
+
+def jobUUID(*key) -> uuid.UUID:
+    """
+    Get a uuid for a file the current job makes from key, it's the same every time the job runs
+    so a job that is resumed or retried finds its partial files, outside of jobs it's random
+    """
+    jid = jobId()
+    if jid == None:
+        return uuid.uuid4()
+    return uuid.uuid5(uuid.UUID(jid), json.dumps(key, default=str))
+
+def siblings(fnames: list[str]) -> list[str]:
+    """
+    Get fnames along with the files in downloadsPath that start with one of them followed by a dot
+    """
+    found = []
+    for fname in fnames:
+        path = os.path.join(conf["downloadsPath"], fname)
+        found += [fname] + [os.path.basename(p) for p in glob.glob(glob.escape(path) + ".*")]
+    return found
+
+def removeFiles(fnames: list[str]) -> int:
+    """
+    Remove files from downloadsPath, files that are already gone are skipped
+    Returns the number of files removed
+    """
+    removed = 0
+    for fname in fnames:
+        path = os.path.join(conf["downloadsPath"], fname)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        cleanedFiles.inc()
+        cleanedBytes.inc(size)
+    return removed
+
+class LocalStore:
+    """
+    Artifacts are kept in downloadsPath and served from there by the instance that made them
+    url is the base url of links, with several instances that don't share downloadsPath set it to each instance's own url
+    """
+    shared = False
+    """ Whether downloadsPath is shared with other nodes """
+
+    def __init__(self, url: str|None = None):
+        self.url = url or conf["url"]
+        # Unique per process so a web instance and a worker on the same host never share a journal
+        self.node = f"{socket.gethostname()}.{os.getpid()}"
+
+    def link(self, fname: str) -> str:
+        """
+        Link clients can download the published artifact fname from
+        """
+        return f"{self.url}/downloads/{fname}"
+
+    async def publish(self, fname: str, staged: str|None = None):
+        """
+        Make the finished artifact fname available to clients
+        staged is the name it was written under, it's renamed to fname atomically first so nobody sees it half written
+        """
+        if staged != None:
+            await runJob("download", os.replace, os.path.join(conf["downloadsPath"], staged), os.path.join(conf["downloadsPath"], fname))
+
+    def record(self, fname: str, size: int|None, expires: float):
+        """
+        Let the node that cleans up know fname was made (with size) or used and until when it should be kept
+        """
+        pass
+
+    async def sync(self, artifacts) -> bool:
+        """
+        Exchange records with the other nodes before a sweep, returns whether this node should remove the files that are due
+        """
+        return True
+
+    async def remove(self, fnames: list[str]) -> int:
+        """
+        Remove published artifacts, returns the number of files removed
+        """
+        return await runJob("download", removeFiles, fnames)
+
+    def stats(self) -> dict:
+        return {
+            "type": type(self).__name__,
+            "node": self.node,
+            "leader": True
+        }
+
+class SharedStore(LocalStore):
+    """
+    downloadsPath is shared by all nodes, e.g. a volume mounted by every replica, so any of them can serve any artifact
+    Only the node holding the leader lease sweeps, the others write what they made and used to their own journal in
+    path (.artifacts in downloadsPath by default) which the leader reads incrementally, so the directory isn't listed on every sweep
+    The lease is taken under a file lock and every file that is read by other nodes is replaced by an atomic rename
+    """
+    shared = True
+
+    def __init__(self, url: str|None = None, path: str|None = None):
+        super().__init__(url)
+        self.path = path or os.path.join(conf["downloadsPath"], ".artifacts")
+        self.ttl = conf.get("artifactTTL", 7200)
+        # A leader that stops renewing its lease is replaced after a few sweeps
+        self.leaseTime = 3 * conf.get("cleanInterval", 60)
+        self.leader = False
+        # Records not written to the journal yet
+        self.pending: list[dict] = []
+        # Latest record per file of this node, the journal is rewritten from these once it has grown too much
+        self.own: dict[str, dict] = {}
+        self.written = 0
+        # Journal -> (inode, bytes read) so the leader only reads what's new and notices rewritten journals
+        self.offsets: dict[str, tuple[int, int]] = {}
+
+    def record(self, fname: str, size: int|None, expires: float):
+        record = {"f": fname, "expires": expires}
+        if size != None:
+            record["size"] = size
+        self.pending.append(record)
+        self.written += 1
+        own = self.own.get(fname)
+        if own == None or size != None:
+            self.own[fname] = dict(record)
+        else:
+            own["expires"] = expires
+
+    async def sync(self, artifacts) -> bool:
+        records, self.pending = self.pending, []
+        compact = None
+        if self.written > 4 * len(self.own) + 1024:
+            now = time.time()
+            self.own = {fname: record for fname, record in self.own.items() if record["expires"] > now}
+            # The rewritten journal already has what's pending
+            compact = list(self.own.values())
+            records = []
+            self.written = len(compact)
+        leader, changes = await runJob("download", self.exchange, records, compact)
+        # Journals aren't ordered among each other so a use can be read before the file was made, fold them per file first
+        latest: dict[str, dict] = {}
+        for change in changes:
+            record = latest.setdefault(change["f"], {"size": None, "expires": 0})
+            record["expires"] = max(record["expires"], change["expires"])
+            if "size" in change:
+                record["size"] = change["size"]
+        for fname, record in latest.items():
+            artifacts.merge(fname, record["size"], record["expires"])
+        if leader and not self.leader:
+            # Take over the files no journal names, e.g. from before downloadsPath was shared
+            await artifacts.adopt()
+        self.leader = leader
+        return leader
+
+    def exchange(self, records: list[dict], compact: list[dict]|None) -> tuple[bool, list[dict]]:
+        """
+        Write this node's records, renew or take the lease and, if this node leads, read what was written since the last sync
+        Runs in a worker thread
+        """
+        os.makedirs(self.path, exist_ok=True)
+        journal = f"{self.node}.jsonl"
+        if compact != None:
+            tmp = os.path.join(self.path, f"{journal}.tmp")
+            with open(tmp, "w") as f:
+                f.writelines(json.dumps(record) + "\n" for record in compact)
+            os.replace(tmp, os.path.join(self.path, journal))
+        if len(records) > 0:
+            # Only this node appends to its journal so writes never interleave
+            with open(os.path.join(self.path, journal), "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+        if not self.elect():
+            # Whoever leads next starts from scratch
+            self.offsets.clear()
+            return False, []
+        changes = []
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            journals = [(e.name, e.path, e.stat()) for e in entries if e.name.endswith(".jsonl")]
+        for name, path, st in journals:
+            inode, offset = self.offsets.get(name, (None, 0))
+            if inode != st.st_ino or offset > st.st_size:
+                offset = 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            # The last line may still be being written
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                try:
+                    changes.append(json.loads(line))
+                except ValueError:
+                    continue
+            self.offsets[name] = (st.st_ino, offset + end)
+            # A journal nobody wrote to for longer than artifactTTL only names files that have expired, e.g. of a node that's gone
+            if name != journal and st.st_mtime + self.ttl < now:
+                os.remove(path)
+                del self.offsets[name]
+        return True, changes
+
+    def elect(self) -> bool:
+        """
+        Renew the leader lease if this node holds it or take it over once it has run out, returns whether this node leads
+        """
+        try:
+            import fcntl
+        except ImportError:
+            # No flock on Windows, the atomic rename still keeps the lease readable and a second leader steps down on the next sweep
+            fcntl = None
+        lease = os.path.join(self.path, "leader.json")
+        with open(os.path.join(self.path, "leader.lock"), "a") as lock:
+            if fcntl != None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(lease, "r") as f:
+                    holder = json.load(f)
+            except (OSError, ValueError):
+                holder = None
+            now = time.time()
+            if holder != None and holder["node"] != self.node and holder["until"] > now:
+                return False
+            tmp = f"{lease}.{self.node}"
+            with open(tmp, "w") as f:
+                json.dump({"node": self.node, "until": now + self.leaseTime}, f)
+            os.replace(tmp, lease)
+            return True
+
+    def stats(self) -> dict:
+        return dict(super().stats(), leader=self.leader)
+
+class S3Store(LocalStore):
+    """
+    Finished artifacts are uploaded to an S3 compatible bucket and links point there so no node has to serve them
+    downloadsPath is scratch space, every node should have its own, and the node that uploaded an artifact removes the
+    object along with its local copy once it expires so each object has exactly one node cleaning it up
+    endpoint can point to any S3 compatible server, e.g. MinIO or moto_server for testing locally, needs boto3
+    Without publicURL links are presigned and valid for artifactTTL seconds
+    """
+    def __init__(self, bucket: str, endpoint: str|None = None, region: str|None = None, prefix: str = "", publicURL: str|None = None, accessKey: str|None = None, secretKey: str|None = None, url: str|None = None):
+        super().__init__(url)
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.region = region
+        self.prefix = prefix
+        self.publicURL = publicURL
+        self.accessKey = accessKey
+        self.secretKey = secretKey
+        self.client = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Get the S3 client, boto3 is only imported once it's needed
+        """
+        with self.lock:
+            if self.client == None:
+                import boto3
+                self.client = boto3.client(
+                    "s3",
+                    endpoint_url=self.endpoint,
+                    region_name=self.region,
+                    aws_access_key_id=self.accessKey,
+                    aws_secret_access_key=self.secretKey
+                )
+        return self.client
+
+    def link(self, fname: str) -> str:
+        key = self.prefix + fname
+        if self.publicURL != None:
+            return f"{self.publicURL}/{urllib.parse.quote(key)}"
+        # Artifacts are published before they're linked so the client is already set up here
+        return self.connect().generate_presigned_url("get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=conf.get("artifactTTL", 7200))
+
+    async def publish(self, fname: str, staged: str|None = None):
+        await super().publish(fname, staged)
+        def upload():
+            self.connect().upload_file(
+                os.path.join(conf["downloadsPath"], fname),
+                self.bucket,
+                self.prefix + fname,
+                ExtraArgs={
+                    "ContentType": mimetypes.guess_type(fname)[0] or "application/octet-stream",
+                    # Names are unique so objects never change
+                    "CacheControl": "public, max-age=31536000, immutable"
+                }
+            )
+        with timed("upload"):
+            await runJob("download", upload)
+
+    async def remove(self, fnames: list[str]) -> int:
+        removed = await super().remove(fnames)
+        def delete():
+            client = self.connect()
+            # At most 1000 keys per request
+            for i in range(0, len(fnames), 1000):
+                client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": self.prefix + fname} for fname in fnames[i:i + 1000]], "Quiet": True})
+        if len(fnames) > 0:
+            await runJob("download", delete)
+        return removed
+
+class Artifacts:
+    """
+    Registry of the files in downloadsPath with their size, the job that made them and when they expire
+    Files expire once they haven't been used for artifactTTL seconds, and when the files take more than diskQuota bytes
+    the least recently used ones are evicted early, files held by running jobs are never removed
+    Intermediate files, like the full video a clip is cut from, are removed as soon as the job that made them is done
+    Sweeps only look at the files that are due so large directories don't have to be listed
+    Files are kept and served by store, with a shared store only the leader removes files and the other nodes just
+    forget theirs once they're due
+    """
+    def __init__(self):
+        self.ttl = conf.get("artifactTTL", 7200)
+        self.quota = conf.get("diskQuota", 0)
+        # file name -> {"size", "owner", "expires"}
+        self.entries: dict[str, dict] = {}
+        # File names from least to most recently used
+        self.lru: OrderedDict[str, None] = OrderedDict()
+        # Heap of (expiry, file name), entries whose file has been used since are skipped
+        self.expiries: list[tuple[float, str]] = []
+        # Job -> intermediate files to remove when it's done
+        self.intermediates: dict[str, list[str]] = {}
+        # Job -> names of the files it's making, see note
+        self.noted: dict[str, set[str]] = {}
+        self.total = 0
+
+    def add(self, fname: str, size: int|None = None, expires: float|None = None, intermediate: bool = False, journal: bool = True):
+        """
+        Register fname, owned by the current job
+        Intermediate files can be registered before they're written so they're removed even if the job fails,
+        they're private to the job so the other nodes are only told about the files that are kept
+        """
+        if size == None:
+            try:
+                size = os.path.getsize(os.path.join(conf["downloadsPath"], fname))
+            except OSError:
+                size = 0
+        if fname in self.entries:
+            self.total -= self.entries[fname]["size"]
+        owner = currentJob.get()
+        if expires == None:
+            expires = time.time() + self.ttl
+        self.entries[fname] = {"size": size, "owner": owner, "expires": expires}
+        self.total += size
+        self.lru[fname] = None
+        self.lru.move_to_end(fname)
+        heapq.heappush(self.expiries, (expires, fname))
+        if intermediate and owner != None:
+            self.intermediates.setdefault(owner, []).append(fname)
+            jobState.note(fname)
+        elif journal:
+            store.record(fname, size, expires)
+
+    def note(self, fname: str):
+        """
+        Remember fname as a file the current job is making, before it's written
+        When the job is done fname and the files starting with fname followed by a dot, e.g. yt-dlp's .part files,
+        are removed unless they were registered by then, so failed stages don't leave partial files behind
+        Can be called from worker threads
+        """
+        owner = currentJob.get()
+        if owner != None:
+            self.noted.setdefault(owner, set()).add(fname)
+        jobState.note(fname)
+
+    def keep(self, fname: str):
+        """
+        Turn the intermediate fname of the current job into a regular artifact, e.g. once it's complete
+        """
+        fnames = self.intermediates.get(currentJob.get(), [])
+        if fname in fnames:
+            fnames.remove(fname)
+        self.add(fname)
+
+    def touch(self, fname: str):
+        """
+        Count a use of fname, keeping it for another full period
+        """
+        entry = self.entries.get(fname)
+        if entry == None:
+            # With a shared store the file may have been made by another node, let the leader know it's still used
+            if store.shared and os.path.basename(fname) == fname and os.path.isfile(os.path.join(conf["downloadsPath"], fname)):
+                store.record(fname, None, time.time() + self.ttl)
+            return
+        entry["expires"] = time.time() + self.ttl
+        self.lru.move_to_end(fname)
+        heapq.heappush(self.expiries, (entry["expires"], fname))
+        if fname not in self.intermediates.get(entry["owner"], ()):
+            store.record(fname, None, entry["expires"])
+        # Every use leaves an outdated entry in the heap, rebuild it before it gets too big
+        if len(self.expiries) > 2 * len(self.entries) + 1024:
+            self.expiries = [(entry["expires"], f) for f, entry in self.entries.items()]
+            heapq.heapify(self.expiries)
+
+    def merge(self, fname: str, size: int|None, expires: float):
+        """
+        Apply a record from a node's journal, registering the file if it was made (size is set) or counting a use of it
+        """
+        entry = self.entries.get(fname)
+        if entry == None:
+            if size != None:
+                self.add(fname, size=size, expires=expires, journal=False)
+        elif expires > entry["expires"]:
+            entry["expires"] = expires
+            self.lru.move_to_end(fname)
+            heapq.heappush(self.expiries, (expires, fname))
+
+    def busy(self, fname: str) -> bool:
+        """
+        Check whether fname is held by a job or is an intermediate of a job that's still running
+        """
+        entry = self.entries[fname]
+        return fname in resultCache.refs or fname in self.intermediates.get(entry["owner"], ())
+
+    def drop(self, fname: str):
+        entry = self.entries.pop(fname)
+        self.total -= entry["size"]
+        del self.lru[fname]
+        resultCache.forget(fname)
+
+    def due(self, evict: bool = True) -> list[str]:
+        """
+        Unregister and return the files that should be removed now, expired ones first and then the least recently used while over quota
+        Files are only evicted for the quota if evict is set, nodes that don't lead a shared store don't know the total
+        """
+        now = time.time()
+        victims = []
+        busy = []
+        while len(self.expiries) > 0 and self.expiries[0][0] <= now:
+            expires, fname = heapq.heappop(self.expiries)
+            entry = self.entries.get(fname)
+            if entry == None or entry["expires"] != expires:
+                continue
+            if self.busy(fname):
+                busy.append(fname)
+                continue
+            self.drop(fname)
+            victims.append(fname)
+        # Busy files are looked at again on the next sweep
+        for fname in busy:
+            heapq.heappush(self.expiries, (self.entries[fname]["expires"], fname))
+        if evict and self.quota > 0 and self.total > self.quota:
+            for fname in list(self.lru):
+                if self.total <= self.quota:
+                    break
+                if not self.busy(fname):
+                    self.drop(fname)
+                    victims.append(fname)
+        return victims
+
+    async def sweep(self) -> int:
+        """
+        Remove the files that are due, returns the number of files removed
+        """
+        # Files held by running jobs are used, this keeps them alive on the leader too
+        for fname in list(resultCache.refs):
+            self.touch(fname)
+        leader = await store.sync(self)
+        victims = self.due(evict=leader)
+        if not leader:
+            return 0
+        return await store.remove(victims)
+
+    async def finish(self, owner: str):
+        """
+        Remove the intermediate files of the job owner once it's done
+        """
+        fnames = self.intermediates.pop(owner, [])
+        for fname in fnames:
+            if fname in self.entries:
+                self.drop(fname)
+        noted = self.noted.pop(owner, set())
+        if len(noted) > 0:
+            fnames += [fname for fname in await runJob("download", siblings, noted) if fname not in self.entries and fname not in fnames]
+        if len(fnames) > 0:
+            await runJob("download", removeFiles, fnames)
+
+    async def adopt(self):
+        """
+        Register the files already in downloadsPath, e.g. from before a restart, expiring them by their modification time
+        This is the only time the directory is listed
+        """
+        def scan() -> list[tuple[str, int, float]]:
+            with os.scandir(conf["downloadsPath"]) as entries:
+                return [(e.name, e.stat().st_size, e.stat().st_mtime) for e in entries if e.is_file()]
+        for fname, size, mtime in await runJob("download", scan):
+            if fname not in self.entries:
+                self.add(fname, size=size, expires=mtime + self.ttl, journal=False)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "files": len(self.entries),
+            "bytes": self.total,
+            "quota": self.quota
+        }
+
+artifacts = Artifacts()
+""" Registry of the files in downloadsPath, configurable with artifactTTL and diskQuota """
+
+stores = {"local": LocalStore, "shared": SharedStore, "s3": S3Store}
+storeConf = dict(conf.get("artifactStore", {}))
+store = stores[storeConf.pop("type", "local")](**storeConf)
+""" Where artifacts are kept and served from, configurable with artifactStore """
+
+class ResultCache:
+    """
+    Cache of finished files in downloadsPath keyed by resultKey
+    Identical conversions get the existing file instead of downloading and transcoding again
+    and identical conversions that are running at the same time share one job
+    Files are published to the store once they're made and registered as artifacts, every hit counts as a use of the file so it's kept for another full period,
+    files held by running jobs are never removed
+    """
+    def __init__(self):
+        # key -> file name
+        self.entries: dict[tuple, str] = {}
+        # file name -> number of jobs holding the file
+        self.refs: dict[str, int] = {}
+        # key -> future of a job that is currently producing the file
+        self.inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key: tuple, make) -> str:
+        """
+        Get the file name for key, awaiting the coroutine function make to produce it if it isn't cached
+        make should return the name of the file it wrote in downloadsPath
+        """
+        fname = self.entries.get(key)
+        if fname != None:
+            # Files can disappear from under us so make sure it's still there
+            if os.path.exists(os.path.join(conf["downloadsPath"], fname)):
+                self.hits += 1
+                artifacts.touch(fname)
+                return fname
+            self.forget(fname)
+        if key in self.inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self.inflight[key])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            fname = await make()
+            # Registered first so the file is removed in time even if publishing it fails
+            artifacts.add(fname)
+            await store.publish(fname)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        except asyncio.CancelledError:
+            # The jobs waiting for the file fail instead of hanging when the job making it is cancelled
+            future.set_exception(RuntimeError("Making the file was cancelled"))
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        future.set_result(fname)
+        self.entries[key] = fname
+        return fname
+
+    @contextlib.contextmanager
+    def hold(self, fname: str):
+        """
+        Context manager to keep fname from being removed while a job is using it
+        """
+        self.refs[fname] = self.refs.get(fname, 0) + 1
+        try:
+            yield fname
+        finally:
+            self.refs[fname] -= 1
+            if self.refs[fname] == 0:
+                del self.refs[fname]
+
+    def forget(self, fname: str):
+        """
+        Drop fname from the cache after it has been deleted
+        """
+        for key in [k for k, v in self.entries.items() if v == fname]:
+            del self.entries[key]
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get hit/miss counts and current size of the cache
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self.entries),
+            "held": len(self.refs)
+        }
+
+resultCache = ResultCache()
+""" Cache of finished conversions """
+
+class PlaylistStream:
+    """
+    Tracks of a playlist that is being downloaded in streaming mode
+    Tracks are added as they are finished and held in the result cache until the stream expires
+    """
+    def __init__(self, ptitle: str):
+        self.ptitle = ptitle
+        # List of (name in zip, file name in downloadsPath)
+        self.entries: list[tuple[str, str]] = []
+        self.finished = False
+        self.error: Exception|None = None
+        self.changed = asyncio.Condition()
+        self.holds = contextlib.ExitStack()
+
+    async def add(self, arcname: str, fname: str):
+        """
+        Add a finished track to the stream
+        """
+        self.holds.enter_context(resultCache.hold(fname))
+        async with self.changed:
+            self.entries.append((arcname, fname))
+            self.changed.notify_all()
+
+    async def finish(self, error: Exception|None = None):
+        """
+        Mark the stream as complete, or as failed if error is given
+        """
+        async with self.changed:
+            self.finished = True
+            self.error = error
+            self.changed.notify_all()
+
+    async def follow(self):
+        """
+        Async generator over the tracks of the stream, waits for tracks that aren't finished yet
+        Raises the error of the playlist job if it failed
+        """
+        i = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: i < len(self.entries) or self.finished)
+            if i < len(self.entries):
+                yield self.entries[i]
+                i += 1
+            elif self.error != None:
+                raise self.error
+            else:
+                return
+
+    def expire(self):
+        """
+        Remove the stream and release its tracks to clean()
+        """
+        playlistStreams.pop(self.ptitle, None)
+        self.holds.close()
+
+playlistStreams: dict[str, PlaylistStream] = {}
+""" Streaming playlists by playlist title """
+
+class ZipStream:
+    """
+    Write only file object that collects the output of zipfile so it can be sent in chunks
+    As it can't seek, zipfile writes data descriptors after each entry instead of going back to fill in the header
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, b) -> int:
+        self.buffer += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        """
+        Get and clear everything written so far
+        """
+        b = bytes(self.buffer)
+        self.buffer.clear()
+        return b
+
+class PlaylistZipHandler(tornado.web.RequestHandler):
+    """
+    Streams a zip of the tracks of a streaming playlist chunk by chunk while the playlist is being downloaded
+    Entries are stored and written as zip64 so nothing has to be known in advance
+    """
+    async def get(self, ptitle: str):
+        stream = playlistStreams.get(ptitle)
+        if stream == None:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/zip")
+        self.set_header("Content-Disposition", f'attachment; filename="{ptitle}.zip"')
+        out = ZipStream()
+        try:
+            with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as myzip:
+                async for arcname, fname in stream.follow():
+                    with open(os.path.join(conf["downloadsPath"], fname), "rb") as f, myzip.open(arcname, "w", force_zip64=True) as dest:
+                        while True:
+                            chunk = await runJob("download", f.read, 1024 * 1024)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            self.write(out.take())
+                            await self.flush()
+        except Exception as e:
+            if not self._headers_written:
+                raise
+            # The status was sent already, cutting the connection before the end of the chunked response
+            # lets clients and proxies tell the zip is incomplete
+            capture_exception(e)
+            self.request.connection.close()
+            return
+        # Whatever is left is the central directory
+        self.write(out.take())
+
+    def write(self, chunk):
+        bytesServed.inc(len(chunk), route="playlists")
+        super().write(chunk)
 
 def resInit(method, spinnerid) -> dict[str]:
     """
@@ -80,17 +1199,870 @@ def resInit(method, spinnerid) -> dict[str]:
 # This will either connect to a message queue or not depending on whether multithreading is specified
 sio = ""
 if "mt" in sys.argv:
-    mgr = socketio.KombuManager('amqp://yda-rabbit')
+    mgr = socketio.KombuManager(conf.get("messageQueue", "amqp://yda-rabbit"))
     sio = socketio.AsyncServer(cors_allowed_origins=conf["allowedorigins"], async_mode="tornado", client_manager=mgr)
 else:
     sio = socketio.AsyncServer(cors_allowed_origins=conf["allowedorigins"], async_mode="tornado")
 
+isWorker = "worker" in sys.argv
+""" Whether this instance is a job worker started with run.py worker """
 
-@sio.event
-async def toMP3(sid, data: dict[str], loop: int=0):
+class SqliteJobQueue:
     """
-    Socketio event, takes the client id, a json payload and a loop count for retries
-    Converts link to mp3 file
+    Job queue stored in a local SQLite database, a stand-in for RabbitMQ for testing and single host setups
+    Workers send their events back through the database and the web instance relays them to the clients,
+    so only one web instance should use a given database
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with contextlib.closing(self.connect()) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, body TEXT, state TEXT, started REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, event TEXT, sid TEXT, data TEXT)")
+
+    def connect(self) -> sqlite3.Connection:
+        # Autocommit, transactions are started explicitly where needed
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def putSync(self, job: dict[str]):
+        with contextlib.closing(self.connect()) as db:
+            db.execute("INSERT INTO jobs (body, state) VALUES (?, 'queued')", (json.dumps(job),))
+
+    async def put(self, job: dict[str]):
+        """
+        Add a job to the queue
+        """
+        await asyncio.to_thread(self.putSync, job)
+
+    def claim(self) -> tuple[int, dict[str]]|None:
+        """
+        Take the oldest queued job, jobs that have been running for longer than jobTimeout are assumed to belong to a dead worker and taken again
+        """
+        with contextlib.closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, body FROM jobs WHERE state = 'queued' OR (state = 'running' AND started < ?) ORDER BY id LIMIT 1",
+                (time.time() - conf.get("jobTimeout", 3600),)
+            ).fetchone()
+            if row != None:
+                db.execute("UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (time.time(), row[0]))
+            db.execute("COMMIT")
+        if row == None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def ack(self, jid: int):
+        with contextlib.closing(self.connect()) as db:
+            db.execute("DELETE FROM jobs WHERE id = ?", (jid,))
+
+    async def consume(self, run, concurrency: int):
+        """
+        Run jobs from the queue with the coroutine function run, at most concurrency at a time
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        async def runOne(jid, job):
+            try:
+                await run(job)
+            finally:
+                await asyncio.to_thread(self.ack, jid)
+                semaphore.release()
+        while True:
+            await semaphore.acquire()
+            claimed = await asyncio.to_thread(self.claim)
+            while claimed == None:
+                await asyncio.sleep(0.5)
+                claimed = await asyncio.to_thread(self.claim)
+            asyncio.create_task(runOne(*claimed))
+
+    def publishSync(self, event: str, data: dict[str], sid):
+        with contextlib.closing(self.connect()) as db:
+            db.execute("INSERT INTO events (event, sid, data) VALUES (?, ?, ?)", (event, sid, json.dumps(data)))
+
+    async def publish(self, event: str, data: dict[str], sid):
+        """
+        Send an event for a client from a worker
+        """
+        await asyncio.to_thread(self.publishSync, event, data, sid)
+
+    def takeEvents(self) -> list[tuple]:
+        with contextlib.closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT id, event, sid, data FROM events ORDER BY id LIMIT 100").fetchall()
+            if len(rows) > 0:
+                db.execute("DELETE FROM events WHERE id <= ?", (rows[-1][0],))
+            db.execute("COMMIT")
+        return rows
+
+    def depth(self) -> int:
+        """
+        Get the number of jobs waiting in the queue
+        """
+        with contextlib.closing(self.connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    async def relay(self):
+        """
+        Emit the events published by workers to the clients, runs on the web instance
+        """
+        while True:
+            rows = await asyncio.to_thread(self.takeEvents)
+            for _, event, sid, data in rows:
+                await sio.emit(event, json.loads(data), sid)
+            if len(rows) == 0:
+                await asyncio.sleep(0.1)
+
+class KombuJobQueue:
+    """
+    Job queue on a durable RabbitMQ (or any other kombu transport) queue
+    Jobs are acknowledged once they are finished so jobs of a worker that dies are delivered to another worker
+    Workers send their events through a write only KombuManager on messageQueue, which the mt web instances listen on
+    """
+    def __init__(self, url: str):
+        # kombu is only loaded when it's used, it's slow to import
+        import kombu
+        import kombu.pools
+        self.producers = kombu.pools.producers
+        self.conn = kombu.Connection(url)
+        exchange = kombu.Exchange("yda-jobs", type="direct", durable=True)
+        self.queue = kombu.Queue("yda-jobs", exchange, routing_key="yda-jobs", durable=True)
+        self.mgr = None
+        # The manager's connection isn't thread safe so events are published one at a time from a single thread,
+        # which also keeps them in order
+        self.publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yda-publish")
+
+    def putSync(self, job: dict[str]):
+        with self.producers[self.conn].acquire(block=True) as producer:
+            producer.publish(
+                job,
+                serializer="json",
+                exchange=self.queue.exchange,
+                routing_key="yda-jobs",
+                declare=[self.queue],
+                delivery_mode="persistent",
+                retry=True
+            )
+
+    async def put(self, job: dict[str]):
+        """
+        Add a job to the queue
+        """
+        await asyncio.to_thread(self.putSync, job)
+
+    def consumeSync(self, loop: asyncio.AbstractEventLoop, run, concurrency: int):
+        # kombu isn't thread safe so messages are acknowledged from this thread once their job is done
+        acks = queue.SimpleQueue()
+        def onMessage(body, message):
+            future = asyncio.run_coroutine_threadsafe(run(body), loop)
+            future.add_done_callback(lambda f: acks.put(message))
+        with self.conn.clone() as conn:
+            # The prefetch count limits how many unacknowledged jobs this worker holds at a time
+            with conn.Consumer(self.queue, callbacks=[onMessage], accept=["json"], prefetch_count=concurrency):
+                while True:
+                    try:
+                        conn.drain_events(timeout=1)
+                    except socket.timeout:
+                        conn.heartbeat_check()
+                    while not acks.empty():
+                        acks.get().ack()
+
+    async def consume(self, run, concurrency: int):
+        """
+        Run jobs from the queue with the coroutine function run, at most concurrency at a time
+        """
+        await asyncio.to_thread(self.consumeSync, asyncio.get_running_loop(), run, concurrency)
+
+    def depth(self) -> int:
+        """
+        Get the number of jobs waiting in the queue
+        """
+        with self.conn.clone() as conn:
+            return self.queue(conn.default_channel).queue_declare(passive=True).message_count
+
+    async def publish(self, event: str, data: dict[str], sid):
+        """
+        Send an event for a client from a worker
+        """
+        if self.mgr == None:
+            self.mgr = socketio.KombuManager(conf.get("messageQueue", "amqp://yda-rabbit"), write_only=True)
+        await asyncio.get_running_loop().run_in_executor(self.publisher, functools.partial(self.mgr.emit, event, data, to=sid))
+
+    async def relay(self):
+        """
+        Events already reach the web instances through the KombuManager
+        """
+        pass
+
+jobQueue: SqliteJobQueue|KombuJobQueue|None = None
+""" Queue jobs are sent to for workers, configured with jobQueue, either sqlite:///path/to/db or a kombu url """
+if conf.get("jobQueue", False) != False:
+    if conf["jobQueue"].startswith("sqlite:///"):
+        jobQueue = SqliteJobQueue(conf["jobQueue"][len("sqlite:///"):])
+    else:
+        jobQueue = KombuJobQueue(conf["jobQueue"])
+    jobQueueDepth = Gauge("yda_job_queue_depth", "Jobs waiting in the job queue for a worker", fn=lambda: {(): jobQueue.depth()})
+
+class JobState:
+    """
+    State of the jobs this process runs in a local SQLite database at path: the request, the stage it's at,
+    the files it makes and the done events it sent
+    Jobs that were running when the process stopped are run again on startup under the same job id, so they pick up
+    their partial downloads, and jobs that were interrupted more than resumes times are given up and their files removed
+    Clients that reconnect get the done events of a job with the resume event and join the job's room for its further events
+    """
+    def __init__(self, path: str|bool = "jobstate.db", resumes: int = 2):
+        self.path = path
+        self.resumes = resumes
+        # Job id -> {"stage", "files", "events"} of the jobs running here, their events go to the room named after the job id
+        self.running: dict[str, dict] = {}
+        if path != False:
+            with contextlib.closing(self.connect()) as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, name TEXT, sid TEXT, client TEXT, data TEXT, "
+                    "stage TEXT, files TEXT, events TEXT, state TEXT, attempts INTEGER, updated REAL)"
+                )
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        # Losing the last update in a power cut only means a stage is done again
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.row_factory = sqlite3.Row
+        return db
+
+    def execute(self, sql: str, args: tuple = ()) -> list[sqlite3.Row]:
+        if self.path == False:
+            return []
+        with contextlib.closing(self.connect()) as db:
+            return db.execute(sql, args).fetchall()
+
+    async def start(self, jid: str, name: str, sid, client: str, data: dict[str]):
+        """
+        Record that the job jid started, or started again
+        """
+        self.running[jid] = {"stage": None, "files": [], "events": []}
+        await asyncio.to_thread(
+            self.execute,
+            "INSERT INTO jobs (id, name, sid, client, data, files, events, state, attempts, updated) VALUES (?, ?, ?, ?, ?, '[]', '[]', 'running', 1, ?) "
+            "ON CONFLICT(id) DO UPDATE SET sid = excluded.sid, state = 'running', attempts = attempts + 1, updated = excluded.updated",
+            (jid, name, sid, client, json.dumps(data), time.time())
+        )
+
+    async def stage(self, stage: str):
+        """
+        Record the stage the current job is at along with the files it has made so far
+        """
+        jid = jobId()
+        job = self.running.get(jid)
+        if job == None:
+            return
+        job["stage"] = stage
+        await asyncio.to_thread(self.execute, "UPDATE jobs SET stage = ?, files = ?, updated = ? WHERE id = ?", (stage, json.dumps(job["files"]), time.time(), jid))
+
+    def note(self, fname: str):
+        """
+        Remember fname as a file of the current job, files starting with fname followed by a dot count too, e.g. yt-dlp's .part files
+        It's written with the next stage, can be called from worker threads
+        """
+        job = self.running.get(jobId())
+        if job != None and fname not in job["files"]:
+            job["files"].append(fname)
+
+    def emitted(self, event: str, data: dict[str]) -> tuple[dict[str], object]|None:
+        """
+        Tag an event of the current job with its id, returns the data to send and the room of the job to send it to
+        or None if it's not a job event
+        """
+        jid = jobId()
+        job = self.running.get(jid)
+        if job == None:
+            return None
+        data = dict(data, jobid=jid)
+        if event == "done":
+            job["events"].append(data)
+        return data, jid
+
+    async def finish(self, jid: str):
+        job = self.running.pop(jid, None)
+        if job == None:
+            return
+        await asyncio.to_thread(self.execute, "UPDATE jobs SET state = 'done', events = ?, updated = ? WHERE id = ?", (json.dumps(job["events"]), time.time(), jid))
+
+    async def get(self, jid: str) -> dict[str]|None:
+        rows = await asyncio.to_thread(self.execute, "SELECT * FROM jobs WHERE id = ?", (jid,))
+        return dict(rows[0]) if len(rows) > 0 else None
+
+    async def recover(self):
+        """
+        Run the jobs that were running when this process stopped again, or give them up if they were resumed too often already
+        """
+        for row in await asyncio.to_thread(self.execute, "SELECT * FROM jobs WHERE state = 'running'"):
+            if row["attempts"] > self.resumes:
+                await self.giveUp(row)
+                continue
+            print(f"Resuming {row['name']} job {row['id']} at {row['stage']}")
+            asyncio.create_task(runAdmitted(row["name"], row["sid"], json.loads(row["data"]), row["client"], row["id"]))
+
+    async def giveUp(self, row: sqlite3.Row):
+        """
+        Fail the interrupted job row, removing its files and leaving the client an error to pick up with resume
+        """
+        await runJob("download", lambda: removeFiles(siblings(json.loads(row["files"]))))
+        data = json.loads(row["data"])
+        res = resInit(data.get("method", row["name"]), data.get("spinnerid"))
+        res["details"] = "Job was interrupted too many times"
+        res["jobid"] = row["id"]
+        await asyncio.to_thread(self.execute, "UPDATE jobs SET state = 'failed', events = ?, updated = ? WHERE id = ?", (json.dumps([res]), time.time(), row["id"]))
+
+    async def prune(self):
+        """
+        Forget jobs nothing happened to for artifactTTL seconds, their files are gone by now
+        """
+        await asyncio.to_thread(self.execute, "DELETE FROM jobs WHERE updated < ? AND state != 'running'", (time.time() - artifacts.ttl,))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "running": len(self.running)
+        }
+
+jobState = JobState(**conf.get("jobState", {}))
+""" Persistent job state, configurable with jobState """
+
+def retryable(e: Exception) -> bool:
+    """
+    Check whether a stage that failed with e is worth trying again: network errors, timeouts and ffmpeg failures are,
+    including the ones yt-dlp wraps, but HTTP errors other than 429 and 5xx get the same answer the next time
+    """
+    # yt-dlp wraps the error that made a download or extraction fail
+    while isinstance(e, (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError)):
+        if isinstance(e, yt_dlp.utils.ExtractorError) and e.cause != None:
+            e = e.cause
+        elif e.exc_info != None and e.exc_info[1] != e:
+            e = e.exc_info[1]
+        else:
+            return False
+    status = None
+    if isinstance(e, yt_dlp.networking.exceptions.HTTPError):
+        status = e.status
+    elif isinstance(e, requests.HTTPError) and e.response != None:
+        status = e.response.status_code
+    if status != None:
+        return status == 429 or status >= 500
+    return isinstance(e, (OSError, yt_dlp.networking.exceptions.TransportError))
+
+async def retryJob(kind: str, fn, *args, **kwargs):
+    """
+    Run the blocking function fn with runJob as a stage of the current job, retrying it with exponential backoff
+    if it fails with an error that's worth trying again, see retryable
+    Files are named after the job so a retry picks up the partial files of the attempt before
+    """
+    retries = conf.get("stageRetries", {})
+    attempts = retries.get("attempts", 3)
+    backoff = retries.get("backoff", 2)
+    for attempt in range(attempts):
+        await jobState.stage(fn.__name__)
+        try:
+            return await runJob(kind, fn, *args, **kwargs)
+        except Exception as e:
+            if attempt + 1 >= attempts or not retryable(e):
+                raise
+            capture_exception(e)
+            # Jitter keeps jobs that failed together from retrying together
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+async def emit(event: str, data: dict[str], sid, ignore_queue: bool=False):
+    """
+    Emit an event to the client, through the job queue when running as a worker
+    Events of persisted jobs carry the job id and go to the room named after it, which the client that sent the job
+    and the clients that resumed it are in, on any instance
+    """
+    tagged = jobState.emitted(event, data)
+    if tagged != None:
+        data, sid = tagged
+        # Clients in the room may be connected to other instances
+        ignore_queue = False
+    with timed("emit"):
+        if isWorker:
+            await jobQueue.publish(event, data, sid)
+        else:
+            await sio.emit(event, data, sid, ignore_queue=ignore_queue)
+
+jobs: dict[str] = {}
+""" Job events by name """
+
+async def runTracked(name: str, sid, data: dict[str], jid: str|None = None, client: str|None = None):
+    """
+    Run the job event name, recording it in the metrics
+    If jid is given the job is persisted in the job state under that id
+    """
+    token = currentEvent.set(name)
+    persisted = jid != None
+    if jid == None:
+        jid = str(uuid.uuid4())
+    owner = f"{name}:{jid}"
+    jtoken = currentJob.set(owner)
+    activeJobs.inc(event=name)
+    profiled = profiler.start(owner)
+    start = time.monotonic()
+    try:
+        if persisted:
+            await jobState.start(jid, name, sid, client, data)
+        await jobs[name](sid, data)
+    finally:
+        activeJobs.dec(event=name)
+        jobSeconds.observe(time.monotonic() - start, event=name)
+        if persisted:
+            await jobState.finish(jid)
+        currentJob.reset(jtoken)
+        currentEvent.reset(token)
+        await artifacts.finish(owner)
+        if profiled:
+            await profiler.finish(owner, name, time.monotonic() - start)
+
+class Admission:
+    """
+    Admission control for job events
+    Every client has a token bucket per sid and per ip, events that find either empty are rejected
+    Admitted jobs run if there's a free slot both overall (maxJobs) and for their type (jobLimits), otherwise they wait
+    Waiting jobs are started by weighted fair queuing: each job gets a virtual finish time of the later of the current virtual time
+    and the finish time of the client's previous job, plus the cost of its type (jobWeights), and the lowest finish time goes first
+    This way cheap jobs like info and subtitles overtake playlists and a client queuing many jobs can't starve the others
+    """
+    def __init__(self):
+        self.maxJobs = conf.get("maxJobs", 16)
+        self.limits = {
+            "getInfoEvent": 16,
+            "subtitles": 8,
+            "toMP3": 8,
+            "clip": 4,
+            "combine": 4,
+            "playlist": 2,
+            "batch": 2
+        }
+        self.limits.update(conf.get("jobLimits", {}))
+        self.weights = {
+            "getInfoEvent": 1,
+            "subtitles": 1,
+            "toMP3": 4,
+            "clip": 4,
+            "combine": 6,
+            "playlist": 20,
+            "batch": 20
+        }
+        self.weights.update(conf.get("jobWeights", {}))
+        self.rate = conf.get("rateLimit", {}).get("rate", 1)
+        self.burst = conf.get("rateLimit", {}).get("burst", 10)
+        # key -> [tokens, time of last refill]
+        self.buckets: dict[str, list[float]] = {}
+        self.running: dict[str, int] = {}
+        self.total = 0
+        # Heap of waiting jobs as [finish, order, name, future]
+        self.waiting: list[list] = []
+        self.order = itertools.count()
+        self.vtime = 0.0
+        # Client -> virtual finish time of its last job
+        self.lastFinish: dict[str, float] = {}
+        # Moving average of job durations by type, for ETAs
+        self.durations: dict[str, float] = {}
+
+    def allow(self, keys: list[str]) -> float:
+        """
+        Take a token from the buckets of all keys, returns 0 if there was one in each or else the number of seconds until there will be
+        """
+        now = time.monotonic()
+        # Forget clients that have been gone long enough for their buckets to be full
+        if len(self.buckets) > 10000:
+            self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < self.burst / self.rate}
+        # and clients whose jobs the virtual time has caught up with, their next job is ordered the same without them
+        if len(self.lastFinish) > 10000:
+            self.lastFinish = {k: v for k, v in self.lastFinish.items() if v > self.vtime}
+        buckets = []
+        for key in keys:
+            bucket = self.buckets.setdefault(key, [self.burst, now])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            buckets.append(bucket)
+        wait = max((1 - b[0]) / self.rate for b in buckets)
+        if wait > 0:
+            return wait
+        for bucket in buckets:
+            bucket[0] -= 1
+        return 0
+
+    def free(self, name: str) -> bool:
+        return self.total < self.maxJobs and self.running.get(name, 0) < self.limits.get(name, self.maxJobs)
+
+    def start(self, name: str):
+        self.total += 1
+        self.running[name] = self.running.get(name, 0) + 1
+
+    def dispatch(self):
+        """
+        Start waiting jobs in order of finish time, skipping the ones whose type is full
+        """
+        skipped = []
+        while len(self.waiting) > 0 and self.total < self.maxJobs:
+            entry = heapq.heappop(self.waiting)
+            finish, _, name, future = entry
+            if future.done():
+                continue
+            if not self.free(name):
+                skipped.append(entry)
+                continue
+            self.vtime = finish
+            self.start(name)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self.waiting, entry)
+
+    def eta(self, name: str, position: int) -> float:
+        """
+        Rough estimate of the seconds until a job of type name at position starts
+        """
+        return round(position * self.durations.get(name, 30) / max(1, min(self.limits.get(name, self.maxJobs), self.maxJobs)), 1)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, name: str, client: str, notify):
+        """
+        Async context manager holding a slot for a job of type name from client
+        If the job has to wait the coroutine function notify is called with its position and ETA
+        """
+        # Jobs that start right away count towards the client's finish time too, so a burst of them puts the client
+        # behind the others once jobs have to wait
+        finish = max(self.vtime, self.lastFinish.get(client, 0)) + self.weights.get(name, 1)
+        self.lastFinish[client] = finish
+        if len(self.waiting) == 0 and self.free(name):
+            self.start(name)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, [finish, next(self.order), name, future])
+            # Jobs of a type that has room start right away even if jobs of full types are waiting
+            self.dispatch()
+            if not future.done():
+                position = sum(1 for entry in self.waiting if entry[0] <= finish and not entry[3].done())
+                await notify(position, self.eta(name, position))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Awaiting the future cancels it too, only a result means the slot was given to us just as we got cancelled
+                if future.done() and not future.cancelled():
+                    self.total -= 1
+                    self.running[name] -= 1
+                    self.dispatch()
+                future.cancel()
+                raise
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.total -= 1
+            self.running[name] -= 1
+            self.durations[name] = 0.8 * self.durations.get(name, time.monotonic() - start) + 0.2 * (time.monotonic() - start)
+            self.dispatch()
+            if self.total == 0 and len(self.waiting) == 0:
+                # Nothing is running anymore so no client is ahead of the others
+                self.lastFinish.clear()
+
+    def stats(self) -> dict[str]:
+        return {
+            "running": dict(self.running),
+            "waiting": sum(1 for entry in self.waiting if not entry[3].done()),
+            "maxJobs": self.maxJobs
+        }
+
+admission = Admission()
+""" Admission control for job events """
+admissionWaiting = Gauge("yda_admission_waiting", "Jobs waiting for an admission slot", fn=lambda: {(): admission.stats()["waiting"]})
+rejectedJobs = Counter("yda_rejected_jobs_total", "Jobs rejected by the rate limit", ("event",))
+
+trustedProxies = [ipaddress.ip_network(proxy, strict=False) for proxy in conf.get("trustedProxies", [])]
+
+def trustedProxy(address: str) -> bool:
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in trustedProxies)
+
+def clientAddress(sid) -> str:
+    """
+    Get the address of the client sid, behind a proxy such as the example Apache config this is the last X-Forwarded-For
+    hop that wasn't added by one of trustedProxies, the entries before it are sent by the client and can't be trusted
+    """
+    environ = sio.get_environ(sid) or {}
+    address = environ.get("REMOTE_ADDR", str(sid))
+    hops = [hop.strip() for hop in environ.get("HTTP_X_FORWARDED_FOR", "").split(",") if hop.strip() != ""]
+    while trustedProxy(address) and hops != []:
+        address = hops.pop()
+    return address
+
+async def runAdmitted(name: str, sid, data: dict[str], client: str, jid: str|None = None):
+    """
+    Run the job event name once admission gives it a slot, the client is told its position in the queue if it has to wait
+    """
+    async def notify(position: int, eta: float):
+        res = resInit(data.get("method", name), data.get("spinnerid"))
+        res["error"] = False
+        res["position"] = position
+        res["eta"] = eta
+        await emit("queued", res, sid)
+    async with admission.slot(name, client, notify):
+        await runTracked(name, sid, data, jid, client)
+
+def job(fn=None, *, local: bool = False):
+    """
+    Decorator to register fn as a job event, this is used instead of sio.event for events that do work
+    Job events go through admission control, clients that send too many are rejected and jobs wait for a slot
+    If there is a job queue the event is sent to the queue for a worker to run, otherwise or if local it runs in this instance
+    Jobs that aren't local are persisted in the job state of whoever runs them under a job id made here
+    """
+    def register(fn):
+        name = fn.__name__
+        jobs[name] = fn
+        async def handler(sid, data: dict[str]):
+            client = clientAddress(sid)
+            wait = admission.allow([f"sid:{sid}", f"ip:{client}"])
+            if wait > 0:
+                rejectedJobs.inc(event=name)
+                res = resInit(data.get("method", name), data.get("spinnerid"))
+                res["details"] = f"Too many requests, try again in {math.ceil(wait)} seconds"
+                await emit("done", res, sid)
+                return
+            if local:
+                await runAdmitted(name, sid, data, client)
+                return
+            jid = str(uuid.uuid4())
+            # The events of the job go to its room so clients can pick them up again with resume
+            await sio.enter_room(sid, jid)
+            if jobQueue == None:
+                await runAdmitted(name, sid, data, client, jid)
+                return
+            try:
+                await jobQueue.put({"name": name, "sid": sid, "data": data, "client": client, "jobid": jid})
+            except Exception as e:
+                capture_exception(e)
+                res = resInit(data.get("method", name), data.get("spinnerid"))
+                res["details"] = str(e)
+                await emit("done", res, sid)
+        sio.on(name, handler)
+        return fn
+    if fn != None:
+        return register(fn)
+    return register
+
+async def emitProgress(sid, payload: dict[str]):
+    """
+    Emit a progress event to the client
+    The client is connected to this instance so the event skips the message queue, this keeps progress from flooding RabbitMQ in mt mode
+    Workers have to go through the queue but progress is rate limited per job
+    """
+    await emit("progress", payload, sid, ignore_queue=True)
+
+class Progress:
+    """
+    Progress reporting for a single job
+    Takes updates from yt-dlp hooks and ffmpeg, which are called from worker threads, and coalesces them
+    into at most progressRate (default 4) progress events a second carrying the latest state
+    """
+    def __init__(self, sid, method: str, spinnerid):
+        self.sid = sid
+        self.base = {
+            "method": method,
+            "spinnerid": spinnerid
+        }
+        self.loop = asyncio.get_running_loop()
+        self.interval = 1 / conf.get("progressRate", 4)
+        self.lock = threading.Lock()
+        self.latest: dict[str] = {}
+        self.scheduled = False
+        self.last = 0.0
+        # Start times of running postprocessors for the metrics
+        self.ppStarted: dict[str, float] = {}
+
+    def update(self, **fields):
+        """
+        Set the latest progress, safe to call from any thread
+        """
+        with self.lock:
+            self.latest = fields
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self.schedule)
+
+    def schedule(self):
+        self.loop.call_later(max(0, self.last + self.interval - time.monotonic()), self.send)
+
+    def send(self):
+        with self.lock:
+            payload = {**self.base, **self.latest}
+            self.scheduled = False
+        self.last = time.monotonic()
+        self.loop.create_task(emitProgress(self.sid, payload))
+
+    def ytdlpHook(self, d: dict[str]):
+        """
+        yt-dlp progress hook
+        """
+        self.update(
+            stage="download",
+            status=d["status"],
+            downloaded=d.get("downloaded_bytes"),
+            total=d.get("total_bytes") or d.get("total_bytes_estimate"),
+            speed=d.get("speed"),
+            eta=d.get("eta")
+        )
+
+    def postprocessorHook(self, d: dict[str]):
+        """
+        yt-dlp postprocessor hook, yt-dlp doesn't report progress inside postprocessors so this only tracks the stage
+        """
+        if d["status"] == "started":
+            self.ppStarted[d.get("postprocessor")] = time.monotonic()
+        elif d["status"] == "finished" and d.get("postprocessor") in self.ppStarted:
+            stageSeconds.observe(time.monotonic() - self.ppStarted.pop(d.get("postprocessor")), event=self.base["method"], stage="postprocess")
+        self.update(
+            stage="postprocess",
+            status=d["status"],
+            postprocessor=d.get("postprocessor")
+        )
+
+    def ffmpegHook(self, done: float, duration: float, speed: str|None):
+        """
+        Progress of runFfmpeg in seconds of output written
+        """
+        # ffmpeg reports speed as a multiple of realtime, e.g. 2.5x
+        eta = None
+        try:
+            eta = (duration - done) / float(speed.rstrip("x"))
+        except (AttributeError, ValueError, ZeroDivisionError):
+            pass
+        self.update(
+            stage="ffmpeg",
+            status="finished" if done >= duration else "processing",
+            done=done,
+            duration=duration,
+            speed=speed,
+            eta=eta
+        )
+
+
+audioCodecs = {
+    "mp3": ("mp3",),
+    "m4a": ("mp4a", "aac"),
+    "opus": ("opus",)
+}
+""" Audio codecs audio can be converted to, with the source codecs that only need to be remuxed into them """
+
+containerCodecs = {
+    "mp4": (("avc1", "h264", "hev1", "hvc1", "h265", "av01"), ("mp4a", "aac", "mp3"), ("libx264", "aac")),
+    "webm": (("vp8", "vp9", "vp09", "av01"), ("opus", "vorbis"), ("libvpx-vp9", "libopus")),
+    "mkv": (None, None, ("libx264", "aac"))
+}
+""" Containers videos can be put in, with the video and audio codecs they hold (None for any) and the encoders for the ones they don't """
+
+def codecMatches(codec: str|None, accepted: tuple[str, ...]|None) -> bool:
+    """
+    Check whether the yt-dlp codec string codec, e.g. avc1.64001F, is one of accepted, unknown codecs never match
+    """
+    if accepted == None:
+        return True
+    return codec != None and codec.split(".")[0].lower() in accepted
+
+def audioPipeline(info: dict, codec: str) -> tuple[str|bool, str]:
+    """
+    Pick the cheapest way to get the audio of info as codec
+    Returns the format to download, False for the best one, and whether it's remuxed or transcoded
+    """
+    audio = [f for f in info.get("formats", []) if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")]
+    matching = [f for f in audio if codecMatches(f.get("acodec"), audioCodecs[codec])]
+    if len(matching) > 0:
+        return max(matching, key=lambda f: f.get("abr") or f.get("tbr") or 0)["format_id"], "remux"
+    return False, "transcode"
+
+def videoPipeline(info: dict, format_id: str|bool, format_id_audio: str|bool, container: str) -> dict[str, str]:
+    """
+    Pick the cheapest way to get the formats of info in container
+    Returns the ffmpeg codec for the video and audio, copy for the streams the container can hold as they are
+    """
+    videoCodecs, audioCodecs, encoders = containerCodecs[container]
+    if format_id != False:
+        formats = {f["format_id"]: f for f in info.get("formats", [])}
+        sources = [formats.get(fid, {}) for fid in (format_id, format_id_audio) if fid != False]
+    else:
+        sources = info.get("requested_formats") or [info]
+    vcodec = next((f["vcodec"] for f in sources if f.get("vcodec") not in (None, "none")), None)
+    acodec = next((f["acodec"] for f in sources if f.get("acodec") not in (None, "none")), None)
+    return {
+        "video": "copy" if codecMatches(vcodec, videoCodecs) else encoders[0],
+        "audio": "copy" if codecMatches(acodec, audioCodecs) else encoders[1]
+    }
+
+def checkQuality(quality) -> str:
+    """
+    Check quality is a bitrate in kbps or a VBR level from 0 (best) to 10 and return it as yt-dlp expects it
+    """
+    quality = str(quality)
+    if not quality.isdigit() or not (int(quality) <= 10 or 32 <= int(quality) <= 320):
+        raise ValueError("Quality has to be a bitrate from 32 to 320 or a VBR level from 0 to 10")
+    return quality
+
+async def audioFile(url: str, info: dict, id3: dict[str]|None, progress: Progress|None = None, codec: str = "mp3", quality="192") -> tuple[str, str]:
+    """
+    Get the audio of the video at url described by info as codec, tagged with id3 if given
+    Sources already in codec are remuxed, others are transcoded at quality
+    Returns the file name in downloadsPath and whether it was remuxed or transcoded, conversions go through the result cache
+    """
+    if codec not in audioCodecs:
+        raise ValueError(f"Codec has to be one of {', '.join(audioCodecs)}")
+    if id3 != None and codec != "mp3":
+        raise ValueError("id3 tags can only be set on mp3s")
+    quality = checkQuality(quality)
+    title = makeSafe(info["title"])
+    format_id, pipeline = audioPipeline(info, codec)
+    async def convert():
+        # Download the audio from given url and get the final title of the video
+        ftitle = await retryJob("transcode", download, url, True, title, codec, format_id=format_id, quality=quality, progress=progress)
+        # If there is id3 metadata apply this metadata to the file
+        if id3 != None:
+            await runJob("transcode", tagID3, os.path.join(conf["downloadsPath"], f"{ftitle}.mp3"), id3)
+        return f"{ftitle}.{codec}"
+    # id3 metadata changes the file so it's part of the key, the quality only matters when transcoding
+    key = resultKey(info, codec=codec, quality=quality if pipeline == "transcode" else None, id3=id3)
+    return await resultCache.get(key, convert), pipeline
+
+async def videoFile(
+        url: str,
+        info: dict,
+        format_id: str|bool = False,
+        format_id_audio: str|bool = False,
+        progress: Progress|None = None,
+        container: str = "mp4"
+    ) -> tuple[str, dict[str, str]]:
+    """
+    Get the video at url described by info in container, in the given formats or the best one
+    Streams the container can hold are copied, the others are transcoded
+    Returns the file name in downloadsPath and the codec used for each stream, conversions go through the result cache
+    """
+    if container not in containerCodecs:
+        raise ValueError(f"Container has to be one of {', '.join(containerCodecs)}")
+    # The uuid keeps two videos with the same title from overwriting each other
+    ptitle = f'{makeSafe(info["title"])}{jobUUID("video", url, format_id, format_id_audio, container)}'
+    streams = videoPipeline(info, format_id, format_id_audio, container)
+    async def merge():
+        if streams["video"] == "copy" and streams["audio"] == "copy":
+            return await retryJob("transcode", download, url, False, ptitle, False, extension=container, format_id=format_id, format_id_audio=format_id_audio, progress=progress, container=container)
+        # Merge into mkv, which holds anything, and only transcode the streams container can't hold
+        source = await retryJob("download", download, url, False, f"{ptitle}.source", False, extension="mkv", format_id=format_id, format_id_audio=format_id_audio, progress=progress, container="mkv")
+        artifacts.add(source, intermediate=True)
+        target = f"{ptitle}.{container}"
+        await retryJob("transcode", convertStreams, os.path.join(conf["downloadsPath"], source), os.path.join(conf["downloadsPath"], target), streams, info.get("duration") or 0, progress=progress)
+        return target
+    return await resultCache.get(resultKey(info, format_id=format_id, format_id_audio=format_id_audio, codec=container), merge), streams
+
+@job
+async def toMP3(sid, data: dict[str]):
+    """
+    Socketio event, takes the client id and a json payload
+    Converts link to an mp3 file, or m4a or opus if asked for with codec
     """
     # Initialize response, if spinnerid data doesn't exist it will just set it to none
     res = resInit("toMP3", data.get("spinnerid"))
@@ -101,61 +2073,45 @@ async def toMP3(sid, data: dict[str], loop: int=0):
         if "list" in url:
             raise ValueError("Method is for singular videos")
         # Get information about the video via yt-dlp to make future decisions
-        info = getInfo(url)
+        info = await infoCache.get(url)
         # Return an error if the video is longer than the configured maximum video length
         if info["duration"] > conf["maxLength"]:
             raise ValueError("Video is longer than configured maximum length")
         else:
             # Get file system safe title for video    
             title = makeSafe(info["title"])
-            # Download video as MP3 from given url and get the final title of the video
-            ftitle = download(url, True, title, "mp3")
+            progress = Progress(sid, "toMP3", data.get("spinnerid"))
+            # The codec (mp3, m4a or opus) and quality can be picked by the client
+            fname, pipeline = await audioFile(url, info, data["id3"], progress, data.get("codec", "mp3"), data.get("quality", "192"))
             # Tell the client there is no error
             res["error"] = False
+            # Tell the client whether the audio was remuxed or transcoded
+            res["pipeline"] = pipeline
             # Give the client the download link
-            res["link"] = f'{conf["url"]}/downloads/{ftitle}.mp3'
+            res["link"] = store.link(fname)
             # Give the client the initial safe title just for display on the ui
             res["title"] = title
-            # If there is id3 metadata apply this metadata to the file
-            if data["id3"] != None:
-                # We use EasyID3 here as, well, it's easy, if you need to add more fields
-                # please read the mutagen documentation for this here:
-                # https://mutagen.readthedocs.io/en/latest/user/id3.html
-                audio = EasyID3(os.path.join(conf["downloadsPath"], f"{ftitle}.mp3"))
-                for key, value in data["id3"].items():
-                    if value != "" and value != None:
-                        audio[key] = value
-                audio.save()
             # Emit result to client
-            await sio.emit("done", res, sid)
-    except OSError as e:
-        capture_exception(e)
-        if loop > 0:
-            capture_exception(OSError("Retry unsuccessful"))
-            # Get text of error
-            res["details"] = str(e)
-            await sio.emit("done", res, sid)
-        else:
-            await toMP3(sid, data, loop=1)
+            await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         # Get text of error
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
     
-@sio.event
-async def playlist(sid, data: dict[str], loop: int=0):
+@job
+async def playlist(sid, data: dict[str]):
     """
-    Downloads playlist as a zip of MP3s
+    Downloads playlist as a zip of MP3s, or m4a or opus if asked for with codec
     """
     res = resInit("playlist", data.get("spinnerid"))
     try:
         purl = data["url"]
         # Get playlist info
-        info = getInfo(purl)
+        info = await infoCache.get(purl)
         # Create playlist title from the file system safe title and a random uuid
         # The uuid is to prevent two users from accidentally overwriting each other's files (very unlikely due to cleanup but still possible)
-        ptitle = makeSafe(info["title"]) + str(uuid.uuid4())
+        ptitle = makeSafe(info["title"]) + str(jobUUID("playlist", purl))
         # If the number of entries is larger than the configured maximum playlist length throw an error
         if len(info["entries"]) > conf["maxPlaylistLength"]:
             raise ValueError("Playlist is longer than configured maximum length")
@@ -165,38 +2121,110 @@ async def playlist(sid, data: dict[str], loop: int=0):
             for v in info["entries"]:
                 if v["duration"] > conf["maxLengthPlaylistVideo"]:
                     raise ValueError("Video in playlist is longer than configured maximum length")
-            # Iterate through all videos on the playlist, download each one as an MP3 and then write it to the playlist zip file
-            for v in info["entries"]:
+            # Codec and quality of the tracks, like toMP3
+            codec = data.get("codec", "mp3")
+            quality = data.get("quality", "192")
+            # Number of tracks to download and convert at the same time
+            semaphore = asyncio.Semaphore(conf.get("playlistConcurrency", 1))
+            # Only one track can be written to the zip at a time
+            zlock = asyncio.Lock()
+            total = len(info["entries"])
+            finished = 0
+            arcnames = set()
+            progress = Progress(sid, "playlist", data.get("spinnerid"))
+            # In streaming mode the zip is never written to disk, instead the tracks are handed to a PlaylistStream
+            # and the client gets a link to download it while it's being built
+            # Workers don't serve http so they can't stream
+            streaming = data.get("stream", conf.get("streamPlaylists", False)) and not isWorker
+            stream = None
+            if streaming:
+                stream = PlaylistStream(ptitle)
+                playlistStreams[ptitle] = stream
+                # Streams live as long as the tracks would on disk
+                asyncio.get_running_loop().call_later(artifacts.ttl, stream.expire)
+                res["error"] = False
+                res["link"] = f'{store.url}/playlists/{ptitle}.zip'
+                res["title"] = makeSafe(info["title"])
+                res["stream"] = True
+                await emit("done", res, sid)
+            async def track(v):
+                nonlocal finished
                 #TODO: make generic
                 vid = v["id"]
                 vurl = "https://www.youtube.com/watch?v=" + vid
                 title = makeSafe(v["title"])
-                ftitle = download(vurl, True, title, "mp3")
-                with zipfile.ZipFile(os.path.join(conf["downloadsPath"], f'{ptitle}.zip'), 'a') as myzip:
-                    myzip.write(os.path.join(conf["downloadsPath"], f"{ftitle}.mp3"))
+                async with semaphore:
+                    # Tracks share the cache with toMP3
+                    fname, _ = await audioFile(vurl, v, None, progress, codec, quality)
+                # Make sure two tracks with the same title don't end up with the same name in the zip
+                arcname = f"{title}.{codec}"
+                n = 1
+                while arcname in arcnames:
+                    n += 1
+                    arcname = f"{title} ({n}).{codec}"
+                arcnames.add(arcname)
+                if streaming:
+                    await stream.add(arcname, fname)
+                else:
+                    with resultCache.hold(fname):
+                        async with zlock:
+                            with timed("zip"):
+                                await runJob("transcode", myzip.write, os.path.join(conf["downloadsPath"], fname), arcname=arcname)
+                finished += 1
+                # Let the client know how far along the playlist is
+                await emitProgress(sid, {
+                    "method": "playlist",
+                    "spinnerid": data.get("spinnerid"),
+                    "stage": "track",
+                    "title": title,
+                    "done": finished,
+                    "total": total
+                })
+            async def runTracks():
+                tasks = [asyncio.create_task(track(v)) for v in info["entries"]]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    # If one track failed there's no point in finishing the others
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+            if streaming:
+                try:
+                    await runTracks()
+                except Exception as e:
+                    # Cut off anyone downloading the stream and tell the client
+                    await stream.finish(e)
+                    stream.expire()
+                    res["error"] = True
+                    del res["link"]
+                    raise
+                await stream.finish()
+                return
+            # Download and convert the videos on the playlist in parallel, each one is written to the playlist zip file as soon as it's finished
+            # MP3s don't compress so they're stored as is
+            # The zip is written under a hidden name and only published once it's complete
+            staged = f'.{ptitle}.zip.part'
+            artifacts.add(staged, intermediate=True)
+            with zipfile.ZipFile(os.path.join(conf["downloadsPath"], staged), 'w', compression=zipfile.ZIP_STORED) as myzip:
+                await runTracks()
+            artifacts.add(f'{ptitle}.zip', size=os.path.getsize(os.path.join(conf["downloadsPath"], staged)))
+            await store.publish(f'{ptitle}.zip', staged)
             res["error"] = False
-            res["link"] = f'{conf["url"]}/downloads/{ptitle}.zip'
-            res["title"] = title
-            await sio.emit("done", res, sid)
-    except OSError as e:
-        capture_exception(e)
-        if loop > 0:
-            # Get text of error
-            res["details"] = str(e)
-            await sio.emit("done", res, sid)
-        else:
-            await playlist(sid, data, loop=1)
+            res["link"] = store.link(f'{ptitle}.zip')
+            res["title"] = makeSafe(info["title"])
+            await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
 
-@sio.event
-async def subtitles(sid, data: dict[str], loop: int=0):
+@job
+async def subtitles(sid, data: dict[str]):
     """
     Two step event
     1. Get list of subtitles
-    2. Download chosen subtitle file
+    2. Download the chosen subtitle file, or files for a list of languages
     """
     res = resInit("subtitles", data.get("spinnerid"))
     try:
@@ -206,7 +2234,7 @@ async def subtitles(sid, data: dict[str], loop: int=0):
             raise ValueError("Method is for singular videos")
         # Step 1 of subtitles is to get the list of subtitles available and return them
         if step == 1:
-            info = getInfo(url, getSubtitles=True)
+            info = await infoCache.get(url, getSubtitles=True)
             title = makeSafe(info["title"])
             res["error"] = False
             res["title"] = title
@@ -216,38 +2244,49 @@ async def subtitles(sid, data: dict[str], loop: int=0):
             res["step"] = 0
             # Again details doesn't need a value it just needs to exist to let the front end know to populate the details column with a select defined by the list provided by select
             res["details"] = ""
-            await sio.emit("done", res, sid)
+            await emit("done", res, sid)
         # Step 2 of subtitles is to download the subtitles to the server and provide that link to the user
         elif step == 2:
-            # Get the selected subtitles by language code
-            languageCode = data["languageCode"]
+            # Get the selected subtitles by language code, this can be a list to get several languages at once
+            languageCodes = data["languageCode"]
+            if isinstance(languageCodes, str):
+                languageCodes = [languageCodes]
             # Check if the user wants to download autosubs
             autoSub = data["autoSub"]
-            info = getInfo(url)
+            # Reuse the extraction from step 1
+            info = await infoCache.get(url, getSubtitles=True)
             title = makeSafe(info["title"])
-            # Download the subtitles
-            # Unfortunately at the moment this requires downloading the lowest quality stream as well, in the future some modification to yt-dlp might be necessary to avoid this
-            ftitle = download(url, False, title, "subtitles", languageCode=languageCode, autoSub=autoSub)
+            async def fetchLanguage(languageCode: str) -> str:
+                track = subtitleTrack(info, languageCode, autoSub)
+                async def fetch():
+                    if track != None:
+                        # Fetch just the subtitle file from the url found in step 1
+                        fname = f"{title}.{jobUUID('subtitles', url, languageCode, track['url'])}.{languageCode}.{track['ext']}"
+                        artifacts.add(fname, intermediate=True)
+                        await retryJob("download", downloadDirect, track["url"], os.path.join(conf["downloadsPath"], fname), httpHeaders=track.get("http_headers"))
+                        artifacts.keep(fname)
+                        return fname
+                    # Otherwise have yt-dlp write only the subtitles
+                    ftitle = await retryJob("download", download, url, False, title, "subtitles", languageCode=languageCode, autoSub=autoSub)
+                    return f"{ftitle}.{languageCode}.vtt"
+                # autoSub only makes a difference when there are no regular subtitles for the language
+                auto = autoSub and languageCode not in info.get("subtitles", {})
+                return await resultCache.get(resultKey(info, codec="subtitles", languageCode=languageCode, autoSub=auto), fetch)
+            fnames = await asyncio.gather(*[fetchLanguage(languageCode) for languageCode in languageCodes])
             res["error"] = False
-            res["link"] = f'{conf["url"]}/downloads/{ftitle}.{languageCode}.vtt'
+            res["link"] = store.link(fnames[0])
+            if len(fnames) > 1:
+                # Links to each language when several were asked for
+                res["links"] = {languageCode: store.link(fname) for languageCode, fname in zip(languageCodes, fnames)}
             res["title"] = title
-            await sio.emit("done", res, sid)
-    except OSError as e:
-        capture_exception(e)
-        if loop > 0:
-            capture_exception(OSError("Retry unsuccessful"))
-            # Get text of error
-            res["details"] = str(e)
-            await sio.emit("done", res, sid)
-        else:
-            await subtitles(sid, data, loop=1)
+            await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
 
-@sio.event
-async def clip(sid, data: dict[str], loop: int=0):
+@job
+async def clip(sid, data: dict[str]):
     """
     Event to clip a given stream and return the clip to the user, the user can optionally convert this clip into a gif
     """
@@ -256,12 +2295,15 @@ async def clip(sid, data: dict[str], loop: int=0):
         url = data["url"]
         if "list" in url:
             raise ValueError("Method is for singular videos")
-        info = getInfo(url)
+        info = await infoCache.get(url)
         # Check if directURL is in the data from the client
         # directURL defines a video url to download from directly instead of through yt-dlp
         directURL = False
         if "directURL" in data.keys():
             directURL = data["directURL"]
+            # ffmpeg would also read local files and use its other protocols
+            if not isinstance(directURL, str) or urllib.parse.urlsplit(directURL).scheme not in ("http", "https"):
+                raise ValueError("directURL has to be an http or https url")
         # Check if user wants to create a gif
         gif = False
         if "gif" in data.keys():
@@ -280,51 +2322,89 @@ async def clip(sid, data: dict[str], loop: int=0):
         if gif and ((timeB - timeA) > conf["maxGifLength"]):
             raise ValueError("Range is too large for gif")
         title = makeSafe(info["title"])
-        # If the directURL is set download directly
-        if directURL != False:
-            ititle = f'{title}.{info["ext"]}'
-            downloadDirect(directURL, os.path.join(conf["downloadsPath"], ititle))      
-        # Otherwise download the video through yt-dlp
-        # If there's no format id just get the default video
-        else:
-            if format_id != False:
-                ititle = download(url, False, title, "mp4", extension=info["ext"], format_id=format_id)
-            else:
-                ititle = download(url, False, title, "mp4", extension=info["ext"])
-        cuuid = uuid.uuid4()
-        if gif:
-            # Clip video and then convert it to a gif
-            (VideoFileClip(os.path.join(conf["downloadsPath"], ititle))).subclip(timeA, timeB).write_gif(os.path.join(conf["downloadsPath"], f"{title}.{cuuid}.clipped.gif"))
-            # Optimize the gif
-            optimize(os.path.join(conf["downloadsPath"], f"{title}.clipped.gif"))
-        else:
-            # Clip the video and return the mp4 of the clip
-            ffmpeg_extract_subclip(os.path.join(conf["downloadsPath"], ititle), timeA, timeB, targetname=os.path.join(conf["downloadsPath"], f"{title}.{cuuid}.clipped.mp4"))
-        res["error"] = False
         # Set the extension to use either to mp4 or gif depending on whether the user wanted a gif
         # The extension is just for creating the url for the clip
         extension = "mp4"
         if gif:
             extension = "gif"
-        res["link"] = f'{conf["url"]}/downloads/{title}.{cuuid}.clipped.{extension}'
+        progress = Progress(sid, "clip", data.get("spinnerid"))
+        # In ranged mode only the part of the video that's needed for the clip is fetched, directly from the stream
+        # ffmpeg can't go through the proxy pool and stream urls are often locked to the ip that extracted them,
+        # so with proxies clips are always downloaded through them
+        ranged = data.get("ranged", conf.get("rangedClips", True)) and conf["proxyListURL"] == False
+        sources = None
+        if ranged:
+            if directURL != False:
+                sources = [{"url": directURL}]
+            else:
+                sources = clipSources(info, format_id)
+        fetched = 0
+        gifStats = {}
+        async def gifJob(src: str, start: int, headers: dict[str, str]|None = None, protocol: str|None = None) -> int:
+            # Make the gif, recording how long it took and how big it is
+            target = os.path.join(conf["downloadsPath"], f"{title}.{cuuid}.clipped.gif")
+            start_time = time.monotonic()
+            read = await retryJob("transcode", makeGif, src, start, start + timeB - timeA, target, headers=headers, protocol=protocol, progress=progress)
+            gifStats["gifTime"] = round(time.monotonic() - start_time, 3)
+            gifStats["gifSize"] = os.path.getsize(target)
+            return read
+        async def makeClip():
+            nonlocal fetched, cuuid, sources
+            cuuid = jobUUID("clip", url, format_id, directURL, extension, timeA, timeB)
+            if sources != None:
+                try:
+                    if gif:
+                        # The gif is made straight from the stream, gifs have no audio so only the first (video) source is needed
+                        fetched = await gifJob(sources[0]["url"], timeA, sources[0].get("http_headers"), sources[0].get("protocol"))
+                    else:
+                        target = os.path.join(conf["downloadsPath"], f"{title}.{cuuid}.clipped.mp4")
+                        fetched = await retryJob("download", clipRanged, sources, timeA, timeB, target, progress=progress)
+                    return f"{title}.{cuuid}.clipped.{extension}"
+                except OSError as e:
+                    # Some streams refuse ranged requests, downloading the whole video still works for those
+                    capture_exception(e)
+                    sources = None
+            # If the directURL is set download directly
+            if directURL != False:
+                ititle = f'{title}.{cuuid}.{info["ext"]}'
+                artifacts.add(ititle, intermediate=True)
+                await retryJob("download", downloadDirect, directURL, os.path.join(conf["downloadsPath"], ititle), progress=progress)
+            # Otherwise download the video through yt-dlp
+            # If there's no format id just get the default video
+            else:
+                if format_id != False:
+                    ititle = await retryJob("download", download, url, False, title, "mp4", extension=info["ext"], format_id=format_id, progress=progress)
+                else:
+                    ititle = await retryJob("download", download, url, False, title, "mp4", extension=info["ext"], progress=progress)
+                # The full video is only needed until the clip is made
+                artifacts.add(ititle, intermediate=True)
+            if gif:
+                # Clip video and then convert it to a gif
+                await gifJob(os.path.join(conf["downloadsPath"], ititle), timeA)
+            else:
+                # Clip the video and return the mp4 of the clip
+                await retryJob("transcode", clipVideo, os.path.join(conf["downloadsPath"], ititle), timeA, timeB, os.path.join(conf["downloadsPath"], f"{title}.{cuuid}.clipped.mp4"), progress=progress)
+            return f"{title}.{cuuid}.clipped.{extension}"
+        cuuid = None
+        fname = await resultCache.get(resultKey(info, format_id=format_id, directURL=directURL, codec=extension, clip=[timeA, timeB]), makeClip)
+        res.update(gifStats)
+        if sources != None:
+            # Report how much less was fetched than a full download, nothing is fetched if the clip was cached
+            res["bytesFetched"] = fetched
+            full = await runJob("download", sourceSize, sources, info["duration"])
+            if full != None:
+                res["bytesSaved"] = max(0, full - fetched)
+        res["error"] = False
+        res["link"] = store.link(fname)
         res["title"] = title
-        await sio.emit("done", res, sid)
-    except OSError as e:
-        capture_exception(e)
-        if loop > 0:
-            capture_exception(OSError("Retry unsuccessful"))
-            # Get text of error
-            res["details"] = str(e)
-            await sio.emit("done", res, sid)
-        else:
-            await clip(sid, data, loop=1)
+        await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
 
-@sio.event
-async def combine(sid, data: dict[str], loop: int=0):
+@job
+async def combine(sid, data: dict[str]):
     """
     Combine audio and video streams
     """
@@ -332,10 +2412,7 @@ async def combine(sid, data: dict[str], loop: int=0):
     try:
         curl = data["url"]
         # Get video info
-        info = getInfo(curl)
-        # Create the video title from the file system safe title and a random uuid
-        # The uuid is to prevent two users from accidentally overwriting each other's files (very unlikely due to cleanup but still possible)
-        ptitle = f'{makeSafe(info["title"])}{uuid.uuid4()}'
+        info = await infoCache.get(curl)
         # If the number of entries is larger than the configured maximum playlist length throw an error
         if "list" in curl:
             raise ValueError("This method is for a single video")
@@ -343,25 +2420,112 @@ async def combine(sid, data: dict[str], loop: int=0):
             # Check the length of the video, if it's too long throw an error
             if info["duration"] > conf["maxLength"]:
                 raise ValueError("Video is longer than configured maximum length")
-            title = download(curl, False, ptitle, False, extension="mp4", format_id=data["format_id"], format_id_audio=data["format_id_audio"])
+            progress = Progress(sid, "combine", data.get("spinnerid"))
+            # Streams are only transcoded if the container (mp4, webm or mkv) can't hold them
+            fname, streams = await videoFile(curl, info, data["format_id"], data["format_id_audio"], progress, data.get("container", "mp4"))
             res["error"] = False
-            res["link"] = f'{conf["url"]}/downloads/{title}'
-            res["title"] = ptitle
-            await sio.emit("done", res, sid)
-    except OSError as e:
+            res["pipeline"] = "remux" if streams["video"] == "copy" and streams["audio"] == "copy" else "transcode"
+            res["streams"] = streams
+            res["link"] = store.link(fname)
+            res["title"] = makeSafe(info["title"])
+            await emit("done", res, sid)
+    except Exception as e:
         capture_exception(e)
-        if loop > 0:
-            # Get text of error
-            res["details"] = str(e)
-            await sio.emit("done", res, sid)
+        res["details"] = str(e)
+        await emit("done", res, sid)
+
+@job
+async def batch(sid, data: dict[str]):
+    """
+    Convert many videos in one event
+    Takes a list of items, each with a url and optionally codec (mp3, the default, m4a, opus or a container: mp4, webm or mkv), quality, id3, format_id, format_id_audio and spinnerid
+    Every item gets its own done event with its index as soon as it's finished, identical items are only converted once
+    If bundle is set the files are also put in one zip, linked by the final done event
+    """
+    res = resInit("batch", data.get("spinnerid"))
+    try:
+        items = data["items"]
+        if len(items) > conf.get("maxBatchLength", 20):
+            raise ValueError("Batch is longer than configured maximum length")
+        # Items for the same video with the same options share one conversion
+        groups: dict[str, list[int]] = {}
+        for i, item in enumerate(items):
+            options = [normalizeURL(item["url"]), item.get("codec", "mp3"), str(item.get("quality", "192")), item.get("id3"), item.get("format_id", False), item.get("format_id_audio", False)]
+            groups.setdefault(json.dumps(options, sort_keys=True), []).append(i)
+        semaphore = asyncio.Semaphore(conf.get("batchConcurrency", 3))
+        bundle = data.get("bundle", False)
+        btitle = f"batch.{jobUUID('batch')}"
+        arcnames = set()
+        zlock = asyncio.Lock()
+        failed = 0
+        async def convert(indexes: list[int], myzip: zipfile.ZipFile|None):
+            nonlocal failed
+            item = items[indexes[0]]
+            ires = resInit("batch", item.get("spinnerid"))
+            try:
+                url = item["url"]
+                if "list" in url:
+                    raise ValueError("Batch items have to be single videos")
+                # Extraction isn't limited so all the items are extracted in parallel, only the conversions wait their turn
+                info = await infoCache.get(url)
+                if info["duration"] > conf["maxLength"]:
+                    raise ValueError("Video is longer than configured maximum length")
+                title = makeSafe(info["title"])
+                progress = Progress(sid, "batch", item.get("spinnerid"))
+                async with semaphore:
+                    codec = item.get("codec", "mp3")
+                    if codec in containerCodecs:
+                        fname, _ = await videoFile(url, info, item.get("format_id", False), item.get("format_id_audio", False), progress, codec)
+                    else:
+                        fname, _ = await audioFile(url, info, item.get("id3"), progress, codec, item.get("quality", "192"))
+                if myzip != None:
+                    # Make sure two items with the same title don't end up with the same name in the zip
+                    ext = fname.rsplit(".", 1)[-1]
+                    arcname = f"{title}.{ext}"
+                    n = 1
+                    while arcname in arcnames:
+                        n += 1
+                        arcname = f"{title} ({n}).{ext}"
+                    arcnames.add(arcname)
+                    with resultCache.hold(fname):
+                        async with zlock:
+                            with timed("zip"):
+                                await runJob("transcode", myzip.write, os.path.join(conf["downloadsPath"], fname), arcname=arcname)
+                ires["error"] = False
+                ires["link"] = store.link(fname)
+                ires["title"] = title
+            except Exception as e:
+                capture_exception(e)
+                failed += len(indexes)
+                ires["details"] = str(e)
+            for i in indexes:
+                await emit("done", dict(ires, index=i, spinnerid=items[i].get("spinnerid")), sid)
+        async def convertAll(myzip: zipfile.ZipFile|None = None):
+            await asyncio.gather(*[convert(indexes, myzip) for indexes in groups.values()])
+        if bundle:
+            # Files are written to the zip as soon as they're finished, the zip is written under a hidden name and only published once it's complete
+            staged = f".{btitle}.zip.part"
+            artifacts.add(staged, intermediate=True)
+            with zipfile.ZipFile(os.path.join(conf["downloadsPath"], staged), "w", compression=zipfile.ZIP_STORED) as myzip:
+                await convertAll(myzip)
         else:
-            await playlist(sid, data, loop=1)
+            await convertAll()
+        if failed == len(items):
+            raise ValueError("No item in the batch could be converted")
+        if bundle:
+            artifacts.add(f"{btitle}.zip", size=os.path.getsize(os.path.join(conf["downloadsPath"], staged)))
+            await store.publish(f"{btitle}.zip", staged)
+            res["link"] = store.link(f"{btitle}.zip")
+        res["error"] = False
+        res["done"] = len(items) - failed
+        res["failed"] = failed
+        await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
 
-@sio.event
+@job(local=True)
 async def getInfoEvent(sid, data: dict[str]):
     """
         Generic event to get all the information provided by yt-dlp for a given url
@@ -372,7 +2536,7 @@ async def getInfoEvent(sid, data: dict[str]):
         url = data["url"]
         if "list" in url:
             raise ValueError("Method is for singular videos")
-        info = getInfo(url)
+        info = await infoCache.get(url)
         if data["method"] == "streams":
             res["details"] = ""
             res["select"] = ""
@@ -381,11 +2545,11 @@ async def getInfoEvent(sid, data: dict[str]):
         res["error"] = False
         res["title"] = title
         res["info"] = info
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
 
 @sio.event
 async def limits(sid, data: dict[str]):
@@ -403,11 +2567,157 @@ async def limits(sid, data: dict[str]):
         ]
         res["limits"] = [{"limitid": limit, "limitvalue": conf[limit]} for limit in limits]
         res["error"] = False
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
     except Exception as e:
         capture_exception(e)
         res["details"] = str(e)
-        await sio.emit("done", res, sid)
+        await emit("done", res, sid)
+
+@sio.event
+async def resume(sid, data: dict[str]):
+    """
+    Re-subscribe to the job with the given jobid, e.g. after reconnecting or a restart of the server
+    The done events the job already sent are sent again and if it's still running its further events go to this client
+    """
+    res = resInit("resume", data.get("spinnerid"))
+    try:
+        jid = data["jobid"]
+        job = jobState.running.get(jid)
+        if job != None:
+            events = job["events"]
+            res["running"] = True
+            res["stage"] = job["stage"]
+        else:
+            # The job may be run by another process sharing the job state, e.g. a worker
+            row = await jobState.get(jid)
+            if row == None:
+                raise ValueError("Unknown job")
+            events = json.loads(row["events"])
+            res["running"] = row["state"] == "running"
+            res["stage"] = row["stage"]
+        # Whichever instance runs the job sends its further events to its room
+        await sio.enter_room(sid, jid)
+        for event in events:
+            await emit("done", event, sid)
+        res["error"] = False
+        res["jobid"] = jid
+        await emit("done", res, sid)
+    except Exception as e:
+        capture_exception(e)
+        res["details"] = str(e)
+        await emit("done", res, sid)
+
+@sio.event
+async def stats(sid, data: dict[str]):
+    """
+    Get statistics of the server's caches for monitoring and sizing
+    """
+    res = resInit("stats", data.get("spinnerid"))
+    try:
+        res["stats"] = {
+            "infoCache": infoCache.stats(),
+            "resultCache": resultCache.stats(),
+            "artifacts": artifacts.stats(),
+            "store": store.stats(),
+            "transcode": cpuBudget.stats(),
+            "ydlPool": ydlPool.stats(),
+            "proxyPool": proxyPool.stats(),
+            "admission": admission.stats(),
+            "jobState": jobState.stats()
+        }
+        res["error"] = False
+        await emit("done", res, sid)
+    except Exception as e:
+        capture_exception(e)
+        res["details"] = str(e)
+        await emit("done", res, sid)
+
+class YoutubeDLPool:
+    """
+    YoutubeDL instances kept by option set (including the proxy) so the extractors, cookies and http connections
+    are set up once instead of on every call
+    An instance is only used by one call at a time, the call sets the output template and the progress to report to while it has it
+    At most size idle instances are kept, the least recently used ones are closed
+    """
+    def __init__(self, size: int):
+        self.size = size
+        # Option set -> idle (YoutubeDL, hooks) pairs
+        self.idle: OrderedDict[str, list[tuple[YoutubeDL, dict]]] = OrderedDict()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def make(self, opts: dict) -> tuple[YoutubeDL, dict]:
+        # The hooks are set once and pass progress on to whoever is using the instance
+        hooks = {"progress": None}
+        def progressHook(d):
+            if hooks["progress"] != None:
+                hooks["progress"].ytdlpHook(d)
+        def postprocessorHook(d):
+            if hooks["progress"] != None:
+                hooks["progress"].postprocessorHook(d)
+        ydl = YoutubeDL(dict(opts, progress_hooks=[progressHook], postprocessor_hooks=[postprocessorHook]))
+        return ydl, hooks
+
+    @contextlib.contextmanager
+    def get(self, opts: dict, outtmpl: str|None = None, progress: Progress|None = None):
+        """
+        Context manager to use a YoutubeDL with opts, writing to outtmpl and reporting to progress if given
+        Instances that raise are closed rather than reused
+        """
+        key = json.dumps(opts, sort_keys=True, default=str)
+        entry = None
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle != None:
+                entry = idle.pop()
+                if len(idle) == 0:
+                    del self.idle[key]
+                self.count -= 1
+                self.reused += 1
+            else:
+                self.created += 1
+        if entry == None:
+            entry = self.make(opts)
+        ydl, hooks = entry
+        if outtmpl != None:
+            ydl.params["outtmpl"]["default"] = outtmpl
+        hooks["progress"] = progress
+        ydl._download_retcode = 0
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        finally:
+            hooks["progress"] = None
+        self.release(key, entry)
+
+    def release(self, key: str, entry: tuple[YoutubeDL, dict]):
+        closing = []
+        with self.lock:
+            self.idle.setdefault(key, []).append(entry)
+            self.idle.move_to_end(key)
+            self.count += 1
+            while self.count > self.size:
+                oldest = next(iter(self.idle))
+                closing.append(self.idle[oldest].pop(0)[0])
+                if len(self.idle[oldest]) == 0:
+                    del self.idle[oldest]
+                self.count -= 1
+        for ydl in closing:
+            ydl.close()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "idle": self.count,
+            "created": self.created,
+            "reused": self.reused
+        }
+
+ydlPool = YoutubeDLPool(conf.get("ydlPoolSize", 16))
+""" Pool of YoutubeDL instances, configurable with ydlPoolSize """
 
 def download(
         url,
@@ -418,27 +2728,34 @@ def download(
         autoSub: bool = False, 
         extension: str|bool = False, 
         format_id: str|bool = False,
-        format_id_audio: str|bool = False
+        format_id_audio: str|bool = False,
+        progress: Progress|None = None,
+        quality: str = "192",
+        container: str|None = None
     ) -> str:
     """
     Generic download method
+    If progress is given download and postprocessing progress is reported to it
+    For audio format_id picks the source format and quality is the quality to transcode at,
+    for video container is the container separate video and audio formats are merged into
     """
-    # Used to avoid filename conflicts
-    ukey = str(uuid.uuid4())
+    # Used to avoid filename conflicts, it's the same when the job is resumed or retried so yt-dlp continues its .part files
+    ukey = str(jobUUID("download", url, isAudio, title, codec, languageCode, autoSub, extension, format_id, format_id_audio, quality, container))
+    artifacts.note(f"{title}.{ukey}")
     # Set the location/name of the output file
-    ydl_opts = {
-        'outtmpl': os.path.join(conf["downloadsPath"], f"{title}.{ukey}")
-    }
+    outtmpl = os.path.join(conf["downloadsPath"], f"{title}.{ukey}")
+    ydl_opts = {}
     # Add extension to filepath if set
     if extension != False:
-        ydl_opts["outtmpl"] += f".{extension}"
+        outtmpl += f".{extension}"
     # If this is audio setup for getting the best audio with the given codec
     if isAudio:
-        ydl_opts['format'] = "bestaudio/best"
+        ydl_opts['format'] = format_id if format_id != False else "bestaudio/best"
+        # The audio is only re-encoded if it isn't in codec already
         ydl_opts['postprocessors'] = [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': codec,
-            'preferredquality': '192',
+            'preferredquality': quality,
         }]
     # Otherwise...
     else:
@@ -447,25 +2764,28 @@ def download(
             ydl_opts['format'] = format_id
             if format_id_audio != False:
                 ydl_opts['format'] += f"+{format_id_audio}"
-                print(ydl_opts['format'])
         # Otherwise if we're downloading subtitles...
         elif codec == "subtitles":
-            # Set up to write the subtitles to disk
+            # Set up to write only the subtitles in the given language to disk, the video itself is skipped
             ydl_opts["writesubtitles"] = True
-            # Further settings to write subtitles
-            ydl_opts['subtitle'] = f'--write-sub --sub-lang {languageCode}'
-            # If the user wants to download auto subtitles set the subtitle field to do so
+            ydl_opts["subtitleslangs"] = [languageCode]
+            ydl_opts["subtitlesformat"] = "vtt"
+            ydl_opts["skip_download"] = True
+            # If the user wants to download auto subtitles include them
             if autoSub:
-                ydl_opts['subtitle'] = f'--write-auto-sub {ydl_opts["subtitle"]}'
-            ydl_opts['format'] = "worst"
+                ydl_opts["writeautomaticsub"] = True
         # Otherwise just download the best video+audio
         else:
             ydl_opts['format'] = None
-    # If there is a proxy list url set up, set yt-dlp to use a random proxy
+        if container != None:
+            ydl_opts['merge_output_format'] = container
+    # If there is a proxy list url set up, set yt-dlp to use a proxy from the pool
     if conf["proxyListURL"] != False:
         ydl_opts['proxy'] = getProxy()
     # Finally, actually download the file/s
-    with YoutubeDL(ydl_opts) as ydl:
+    # Download times depend on the size of the file so they don't count as proxy latency
+    # yt-dlp postprocessing is part of this stage, it's also recorded separately as postprocess through the hooks
+    with timed("download"), proxyPool.using(ydl_opts.get('proxy'), timed=False), ydlPool.get(ydl_opts, outtmpl, progress) as ydl:
         if codec == "subtitles":
             ydl.extract_info(url, download=True)
         else:
@@ -476,24 +2796,124 @@ def download(
         res += f".{extension}"
     return res
 
+directSessions: dict[str|None, requests.Session] = {}
+""" Sessions for direct downloads by proxy """
+directSessionsLock = threading.Lock()
+
+def directSession(proxy: str|None) -> requests.Session:
+    """
+    Get the session for downloading through proxy (None for no proxy)
+    Sessions keep their connections open so downloads from the same host reuse them
+    """
+    with directSessionsLock:
+        session = directSessions.get(proxy)
+        if session == None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=poolSizes["download"])
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if proxy != None:
+                session.proxies = {'https': f'https://{proxy}'}
+            directSessions[proxy] = session
+    return session
+
+def maxDirectBytes() -> int:
+    """
+    Maximum size of a direct download in bytes, the size of a video of maxLength seconds at maxBitrate bits per second
+    """
+    return conf["maxLength"] * conf.get("maxBitrate", 20000000) // 8
+
 # Download file directly, with random proxy if set up
-def downloadDirect(url: str|bytes, filename: str|bytes|os.PathLike):
+def downloadDirect(url: str|bytes, filename: str|bytes|os.PathLike, progress: Progress|None = None, retries: int = 3, httpHeaders: dict[str, str]|None = None):
     """
     Download file directly, with random proxy if set up
+    Connections are pooled per proxy, the read size adapts to the speed of the transfer, interrupted transfers are resumed
+    with range requests up to retries times and downloads larger than maxDirectBytes are aborted
+    httpHeaders are sent with every request, e.g. the ones yt-dlp gives for a stream
+    If filename already has part of the file, e.g. from a job that was interrupted, the download continues from there
     """
+    proxy = None
     if conf["proxyListURL"] != False:
-        proxies = {'https': f'https://{getProxy()}'}
-        with requests.get(url, proxies=proxies, stream=True) as r:
-            r.raise_for_status()
-            with open(filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-    else:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
+        proxy = getProxy()
+    session = directSession(proxy)
+    limit = maxDirectBytes()
+    total = None
+    attempt = 0
+    # Read size, doubled while reads are quick and halved when they're slow
+    chunkSize = 64 * 1024
+    start = time.monotonic()
+    with timed("download"), open(filename, 'ab') as f:
+        done = f.tell()
+        while True:
+            # Identity encoding so byte ranges match what's written to disk
+            headers = dict(httpHeaders or {})
+            headers["Accept-Encoding"] = "identity"
+            if done > 0:
+                headers["Range"] = f"bytes={done}-"
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=30) as r:
+                    if done > 0 and r.status_code == 416:
+                        # Nothing left after what's already there, if that is the whole file the download is done
+                        if r.headers.get("Content-Range", "") == f"bytes */{done}":
+                            break
+                        f.truncate(0)
+                        done = 0
+                        continue
+                    try:
+                        r.raise_for_status()
+                    except requests.HTTPError as e:
+                        # Rate limits are the proxy's fault, other errors are the server's
+                        if r.status_code == 429:
+                            proxyPool.report(proxy, False, quarantine=True)
+                        raise
+                    proxyPool.report(proxy, True, r.elapsed.total_seconds())
+                    if done > 0 and r.status_code != 206:
+                        # The server doesn't support ranges, start over
+                        f.seek(0)
+                        f.truncate()
+                        done = 0
+                    if total == None:
+                        if r.status_code == 206:
+                            total = r.headers.get("Content-Range", "/*").split("/")[-1]
+                            total = int(total) if total.isdigit() else None
+                        elif r.headers.get("Content-Length", "").isdigit():
+                            total = int(r.headers["Content-Length"])
+                    if total != None and total > limit:
+                        raise ValueError("File is larger than configured maximum size")
+                    while True:
+                        readStart = time.monotonic()
+                        chunk = r.raw.read(chunkSize)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        done += len(chunk)
+                        if done > limit:
+                            raise ValueError("File is larger than configured maximum size")
+                        took = time.monotonic() - readStart
+                        if took < 0.05 and len(chunk) == chunkSize:
+                            chunkSize = min(chunkSize * 2, 1024 * 1024)
+                        elif took > 0.5:
+                            chunkSize = max(chunkSize // 2, 64 * 1024)
+                        if progress != None:
+                            speed = done / max(time.monotonic() - start, 0.001)
+                            progress.update(
+                                stage="download",
+                                status="downloading",
+                                downloaded=done,
+                                total=total,
+                                speed=speed,
+                                eta=(total - done) / speed if total != None else None
+                            )
+                if total == None or done >= total:
+                    break
+                # The connection closed early, resume
+                raise requests.ConnectionError("Connection closed before the download finished")
+            except (requests.ConnectionError, requests.Timeout, urllib3.exceptions.HTTPError) as e:
+                proxyPool.reportError(proxy, e)
+                attempt += 1
+                if attempt > retries:
+                    raise OSError(f"Direct download failed: {e}")
+                time.sleep(0.5 * 2 ** attempt)
 
 # Generic method to get sanitized information about the given url, with a random proxy if set up
 # Try to write subtitles if requested
@@ -502,16 +2922,280 @@ def getInfo(url, getSubtitles: bool=False):
     Generic method to get sanitized information about the given url, with a random proxy if set up
     Try to write subtitles if requested
     """
-    info = {
+    ydl_opts = {
         "writesubtitles": getSubtitles
     }
     if conf["proxyListURL"] != False:
-        info['proxy'] = getProxy()
-    with YoutubeDL({}) as ydl:
+        ydl_opts['proxy'] = getProxy()
+    with timed("extract"), proxyPool.using(ydl_opts.get('proxy')), ydlPool.get(ydl_opts) as ydl:
         info = ydl.extract_info(url, download=False)
         info = ydl.sanitize_info(info)
     return info
 
+subtitleExts = ("vtt", "srt", "ass")
+""" Subtitle formats clients can use, in order of preference """
+
+def subtitleTrack(info: dict, languageCode: str, autoSub: bool) -> dict|None:
+    """
+    Find the subtitle track for languageCode in info, from the automatic captions if autoSub
+    Returns None if the track has no url to fetch it from directly
+    """
+    tracks = info.get("subtitles", {}).get(languageCode)
+    if tracks == None and autoSub:
+        tracks = info.get("automatic_captions", {}).get(languageCode)
+    if tracks == None:
+        raise ValueError(f"No subtitles for {languageCode}")
+    tracks = [t for t in tracks if t.get("url") != None]
+    for ext in subtitleExts:
+        for track in tracks:
+            if track.get("ext") == ext:
+                return track
+    return None
+
+def tagID3(path: str, tags: dict[str]):
+    """
+    Apply id3 metadata to the mp3 at path, empty values are skipped
+    """
+    # We use EasyID3 here as, well, it's easy, if you need to add more fields
+    # please read the mutagen documentation for this here:
+    # https://mutagen.readthedocs.io/en/latest/user/id3.html
+    with timed("id3"):
+        from mutagen.easyid3 import EasyID3
+        audio = EasyID3(path)
+        for key, value in tags.items():
+            if value != "" and value != None:
+                audio[key] = value
+        audio.save()
+
+transcodeEvents = ("toMP3", "clip", "combine", "playlist", "batch")
+""" Events whose jobs may run ffmpeg """
+
+class CpuBudget:
+    """
+    Shares the cores between the ffmpeg processes of concurrent jobs, by default each of them uses all cores
+    and they slow each other down
+    Every ffmpeg gets cores divided by the number of jobs that may be transcoding as -threads, counting both the running
+    ffmpeg processes and the active jobs of transcodeEvents so a burst of jobs splits the cores before the first one gets to ffmpeg
+    ffmpeg also runs under nice and ionice where they're available so transcodes don't slow down the event loop
+    """
+    def __init__(self, enabled: bool = True, cores: int = 0, minThreads: int = 1, nice: int = 10, ionice: int|None = 7):
+        self.enabled = enabled
+        self.cores = cores or os.cpu_count() or 1
+        self.minThreads = minThreads
+        self.running = 0
+        self.lock = threading.Lock()
+        self.prefix = []
+        if nice and shutil.which("nice") != None:
+            self.prefix += ["nice", "-n", str(nice)]
+        if ionice != None and shutil.which("ionice") != None:
+            # Lowest priorities of the best effort class, the idle class could starve transcodes completely
+            self.prefix += ["ionice", "-c", "2", "-n", str(ionice)]
+
+    def demand(self) -> int:
+        """
+        Number of jobs the cores are shared between right now
+        """
+        jobs = sum(activeJobs.values.get((event,), 0) for event in transcodeEvents)
+        return max(self.running, int(jobs), 1)
+
+    @contextlib.contextmanager
+    def claim(self):
+        """
+        Context manager reserving a share of the cores for one ffmpeg process, yields the number of threads it should use
+        """
+        with self.lock:
+            self.running += 1
+            threads = max(self.minThreads, self.cores // self.demand())
+        try:
+            yield threads
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def command(self, args: list[str], threads: int) -> list[str]:
+        """
+        Add the thread limits for the decoders, filters and encoder to the ffmpeg arguments args, the last of which is the output
+        """
+        if not self.enabled:
+            return ["ffmpeg"] + args
+        limited = ["-filter_threads", str(threads), "-filter_complex_threads", str(threads)]
+        for arg in args[:-1]:
+            if arg == "-i":
+                limited += ["-threads", str(threads)]
+            limited.append(arg)
+        return self.prefix + ["ffmpeg"] + limited + ["-threads", str(threads), args[-1]]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "cores": self.cores,
+            "running": self.running,
+            "threads": max(self.minThreads, self.cores // self.demand())
+        }
+
+cpuBudget = CpuBudget(**conf.get("transcodeBudget", {}))
+""" Thread budget of ffmpeg processes, configurable with transcodeBudget """
+
+def runFfmpeg(args: list[str], duration: float, progress: Progress|None = None):
+    """
+    Run ffmpeg with the given arguments, the last of which is the output, reporting progress to progress if given
+    duration is the expected length of the output in seconds, used to tell how far along ffmpeg is
+    Returns the number of bytes ffmpeg read from its inputs
+    """
+    # Verbose logging is needed for the input statistics, it's read in a separate thread so the pipe can't fill up
+    # A failed run leaves a partial output behind
+    artifacts.note(os.path.basename(args[-1]))
+    args = ["-y", "-hide_banner", "-loglevel", "verbose", "-nostats", "-progress", "pipe:1"] + args
+    with cpuBudget.claim() as threads, timed("ffmpeg"), subprocess.Popen(cpuBudget.command(args, threads), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        log = []
+        reader = threading.Thread(target=lambda: log.extend(proc.stderr))
+        reader.start()
+        # ffmpeg writes blocks of key=value lines, each ending with a progress line
+        done = 0.0
+        speed = None
+        for line in proc.stdout:
+            key, _, value = line.strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                done = int(value) / 1000000
+            elif key == "speed":
+                speed = value
+            elif key == "progress" and progress != None:
+                progress.ffmpegHook(duration if value == "end" else min(done, duration), duration, speed)
+        reader.join()
+    if proc.returncode != 0:
+        raise OSError(f"ffmpeg failed: {''.join(log[-5:]).strip()}")
+    # Every input logs a line like [AVIOContext @ 0x...] Statistics: 1234 bytes read, 2 seeks
+    return sum(int(m.group(1)) for m in re.finditer(r"Statistics: (\d+) bytes read", "".join(log)))
+
+def convertStreams(path: str, target: str, streams: dict[str, str], duration: float, progress: Progress|None = None):
+    """
+    Write the video at path to target with the ffmpeg codec given for its video and audio, copy for the ones that are kept as they are
+    """
+    args = ["-i", path, "-map", "0:v?", "-map", "0:a?", "-c:v", streams["video"], "-c:a", streams["audio"]]
+    # Fast encoder settings, these are downloads rather than archives
+    if streams["video"] == "libx264":
+        args += ["-preset", "veryfast"]
+    elif streams["video"] == "libvpx-vp9":
+        args += ["-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1"]
+    runFfmpeg(args + [target], duration, progress)
+
+def clipVideo(path: str, timeA: int, timeB: int, target: str, progress: Progress|None = None):
+    """
+    Cut timeA to timeB out of the video at path into target without re-encoding
+    """
+    runFfmpeg(["-ss", str(timeA), "-i", path, "-t", str(timeB - timeA), "-map", "0", "-c", "copy", target], timeB - timeA, progress)
+
+def inputArgs(src: str, headers: dict[str, str]|None = None, protocol: str|None = None) -> list[str]:
+    """
+    Get ffmpeg/ffprobe arguments for the next input src, a file or url, sending the given http headers with urls
+    Urls may only use http(s), and what HLS needs when protocol is an HLS protocol of yt-dlp, and files only files,
+    so an input can't make ffmpeg read local files or use its other protocols
+    """
+    if urllib.parse.urlsplit(src).scheme not in ("http", "https"):
+        return ["-protocol_whitelist", "file"]
+    protocols = "http,https,tcp,tls"
+    if protocol in ("m3u8", "m3u8_native"):
+        protocols += ",crypto,hls"
+    args = ["-protocol_whitelist", protocols]
+    if headers:
+        args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    return args
+
+def isKeyframe(src: str, t: float, headers: dict[str, str]|None = None, protocol: str|None = None) -> bool:
+    """
+    Check whether the video in src has a keyframe at t seconds, only the packets right after t are read
+    Returns False if ffprobe isn't available or the check fails
+    """
+    if shutil.which("ffprobe") == None:
+        return False
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+        "-read_intervals", f"{t}%+2", "-show_entries", "frame=pts_time", "-of", "csv=p=0"
+    ] + inputArgs(src, headers, protocol) + [src]
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=60, check=True).stdout
+        return any(abs(float(line.strip(" ,")) - t) < 0.05 for line in out.splitlines() if line.strip(" ,") != "")
+    except (subprocess.SubprocessError, ValueError):
+        return False
+
+# Protocols of yt-dlp formats ffmpeg can seek in by itself
+rangedProtocols = {"http", "https", "m3u8", "m3u8_native"}
+
+def clipSources(info: dict, format_id: str|bool) -> list[dict]|None:
+    """
+    Get the yt-dlp formats to clip from for format_id, or the default format(s) if there is none
+    Returns None if the formats can't be clipped with ranged requests
+    """
+    if format_id != False:
+        formats = {f["format_id"]: f for f in info.get("formats", [])}
+        sources = [formats.get(fid) for fid in format_id.split("+")]
+    else:
+        sources = info.get("requested_formats") or [info]
+    if any(f == None or f.get("url") == None or f.get("protocol", "https") not in rangedProtocols for f in sources):
+        return None
+    return sources
+
+def sourceSize(sources: list[dict], duration: float) -> int|None:
+    """
+    Estimate the full size of the given formats in bytes, for directURLs without a known size a HEAD request is made
+    """
+    size = 0
+    for f in sources:
+        fsize = f.get("filesize") or f.get("filesize_approx")
+        if fsize == None and f.get("tbr") != None:
+            fsize = f["tbr"] * 1000 / 8 * duration
+        if fsize == None and "format_id" not in f:
+            try:
+                fsize = int(requests.head(f["url"], allow_redirects=True, timeout=10).headers["Content-Length"])
+            except (requests.RequestException, KeyError, ValueError):
+                pass
+        if fsize == None:
+            return None
+        size += int(fsize)
+    return size
+
+def clipRanged(sources: list[dict], timeA: int, timeB: int, target: str, progress: Progress|None = None) -> int:
+    """
+    Cut timeA to timeB out of the remote streams in sources into target without downloading them
+    ffmpeg seeks in the streams with range requests so only the segments covering the clip are fetched
+    sources are yt-dlp formats with a url and optionally http_headers, either one with video and audio or a video and an audio format
+    The clip is stream copied if timeA falls on a keyframe and re-encoded otherwise so the cut is exact
+    Returns the number of bytes fetched
+    """
+    copy = isKeyframe(sources[0]["url"], timeA, sources[0].get("http_headers"), sources[0].get("protocol"))
+    args = []
+    for source in sources:
+        args += inputArgs(source["url"], source.get("http_headers"), source.get("protocol")) + ["-ss", str(timeA), "-to", str(timeB), "-i", source["url"]]
+    if len(sources) > 1:
+        args += ["-map", "0:v:0", "-map", "1:a:0"]
+    else:
+        args += ["-map", "0:v:0?", "-map", "0:a:0?"]
+    if copy:
+        args += ["-c", "copy"]
+    else:
+        args += ["-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac"]
+    args += ["-movflags", "+faststart", target]
+    return runFfmpeg(args, timeB - timeA, progress)
+
+def makeGif(path: str, timeA: int, timeB: int, target: str, headers: dict[str, str]|None = None, protocol: str|None = None, progress: Progress|None = None) -> int:
+    """
+    Clip the video at path, a file or url, from timeA to timeB and convert it to a gif at target
+    This is a single ffmpeg pass that generates a palette for the clip and maps the frames onto it,
+    scaled down to fit maxGifResolution and capped at maxGifFps frames per second
+    Returns the number of bytes read
+    """
+    res = conf["maxGifResolution"]
+    vf = (
+        f"fps={conf.get('maxGifFps', 15)},"
+        f"scale=w='min(iw,{res})':h='min(ih,{res})':force_original_aspect_ratio=decrease:flags=lanczos,"
+        "split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle"
+    )
+    read = runFfmpeg(inputArgs(path, headers, protocol) + ["-ss", str(timeA), "-to", str(timeB), "-i", path, "-an", "-filter_complex", vf, "-loop", "0", target], timeB - timeA, progress)
+    # Optimize the gif further if gifsicle is installed
+    if shutil.which("gifsicle") != None:
+        from pygifsicle import optimize
+        optimize(target)
+    return read
+
 def makeSafe(filename):
     """
     # Make title file system safe
@@ -519,45 +3203,271 @@ def makeSafe(filename):
     """
     return "".join([c for c in filename if c.isalpha() or c.isdigit() or c==' ']).rstrip()
 
-# Get random proxy from proxy list
+# Get proxy from proxy pool
 def getProxy() -> str:
     """
-    Get random proxy from proxy list
+    Get a proxy from the proxy pool, faster and healthier proxies are more likely
     """
-    proxy = ""
-    with open("proxies.txt", "r") as f:
-        proxy = random.choice(f.read().split("\n"))
-    return proxy
+    return proxyPool.pick()
 
 async def refreshProxies():
     """
     Refresh proxies every hour
     """
     while True:
-        dlProxies()
+        try:
+            await runJob("download", dlProxies)
+        except Exception as e:
+            # Keep using the current proxies
+            capture_exception(e)
         await asyncio.sleep(3600)
 
-async def clean():
+loopLag = Histogram(
+    "yda_loop_lag_seconds", "How late the event loop woke up the watchdog", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10)
+)
+loopBlocks = Counter("yda_loop_blocked_total", "Times the event loop was blocked for longer than the watchdog threshold", ("event",))
+
+def frameJob(frame) -> tuple[str, object, str|None]|None:
+    """
+    Find the event the stack at frame runs for, returns (event, sid, job) or None if it isn't running for one
+    Jobs are found by their runTracked frame, other code by the outermost function of this module with a sid
+    """
+    found = None
+    while frame != None:
+        if frame.f_globals is globals() and frame.f_code.co_name == "runTracked":
+            return frame.f_locals.get("name"), frame.f_locals.get("sid"), frame.f_locals.get("owner")
+        if frame.f_globals is globals() and "sid" in frame.f_code.co_varnames + frame.f_code.co_freevars:
+            found = (frame.f_code.co_qualname, frame.f_locals.get("sid"), None)
+        frame = frame.f_back
+    return found
+
+class Watchdog:
+    """
+    Watches the event loop from a thread, the loop sets a heartbeat every interval seconds and when it's late by more than
+    threshold seconds the stack the loop is stuck in is logged and sent to Sentry along with the event and sid it's running for
+    Configurable with the loopWatchdog section of the config
+    """
+    def __init__(self, threshold: float = 1, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.beat = time.monotonic()
+        self.reported = None
+        self.loopThread = None
+
+    async def run(self):
+        """
+        Heartbeat task, starts the watching thread
+        """
+        self.loopThread = threading.get_ident()
+        threading.Thread(target=self.watch, name="watchdog", daemon=True).start()
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            loopLag.observe(max(0, time.monotonic() - self.beat - self.interval))
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            beat = self.beat
+            late = time.monotonic() - beat - self.interval
+            # Every block is reported once
+            if late < self.threshold or beat == self.reported:
+                continue
+            self.reported = beat
+            self.report(late, sys._current_frames().get(self.loopThread))
+
+    def report(self, late: float, frame):
+        stack = "".join(traceback.format_stack(frame)) if frame != None else ""
+        event, sid, _ = frameJob(frame) or ("unknown", None, None)
+        loopBlocks.inc(event=event)
+        print(f"Event loop blocked for {late:.2f}s and counting by {event} for {sid}:\n{stack}", file=sys.stderr)
+        with sentry_sdk.new_scope() as scope:
+            scope.set_tag("event", event)
+            scope.set_extra("sid", str(sid))
+            scope.set_extra("stack", stack)
+            sentry_sdk.capture_message(f"Event loop blocked by {event}", level="warning")
+
+watchdog = Watchdog(**conf.get("loopWatchdog", {}))
+""" Event loop watchdog, configurable with the loopWatchdog section of the config """
+
+class Profiler:
     """
-    Clean all files that are older than an hour out of downloads every hour
+    Opt in sampling profiler for jobs, every Nth job has the stacks of the event loop and of the worker threads working for it
+    sampled every interval seconds, jobs that take at least minSeconds have their samples written to path
+    Samples are written in the folded format read by flamegraph.pl and speedscope
+    Configurable with the profileJobs section of the config, off unless every is set
     """
+    def __init__(self, every: int = 0, minSeconds: float = 10, interval: float = 0.01, path: str = "profiles"):
+        self.every = every
+        self.minSeconds = minSeconds
+        self.interval = interval
+        self.path = path
+        self.count = 0
+        # Job -> folded stack -> number of samples
+        self.samples: dict[str, dict[str, int]] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loopThread = None
+
+    def start(self, owner: str) -> bool:
+        """
+        Start sampling the job owner if it's its turn, returns whether it's sampled
+        """
+        if self.every <= 0:
+            return False
+        self.count += 1
+        if self.count % self.every != 0:
+            return False
+        with self.lock:
+            self.samples[owner] = {}
+        if self.thread == None:
+            self.loopThread = threading.get_ident()
+            self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+            self.thread.start()
+        return True
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if len(self.samples) == 0:
+                    continue
+                for ident, frame in sys._current_frames().items():
+                    if ident == self.loopThread:
+                        job = frameJob(frame)
+                        owner = job[2] if job != None else None
+                    else:
+                        owner = threadJobs.get(ident)
+                    if owner in self.samples:
+                        stack = []
+                        while frame != None:
+                            stack.append(f"{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                            frame = frame.f_back
+                        folded = ";".join(reversed(stack))
+                        self.samples[owner][folded] = self.samples[owner].get(folded, 0) + 1
+
+    async def finish(self, owner: str, name: str, seconds: float):
+        """
+        Stop sampling the job owner of event name and write its samples if it was slow
+        """
+        with self.lock:
+            samples = self.samples.pop(owner, {})
+        if seconds < self.minSeconds or len(samples) == 0:
+            return
+        def write():
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, f"{name}.{int(time.time())}.{owner.split(':')[1]}.folded"), "w") as f:
+                for folded, count in samples.items():
+                    f.write(f"{folded} {count}\n")
+        await runJob("download", write)
+
+profiler = Profiler(**conf.get("profileJobs", {}))
+""" Sampling profiler for slow jobs """
+
+async def clean(adopt: bool = True):
+    """
+    Remove expired artifacts and evict the least recently used ones over the disk quota every cleanInterval seconds
+    Files left in downloads from before a restart are adopted first if adopt is set, with a shared store whichever node
+    becomes the leader adopts them instead
+    """
+    os.makedirs(conf["downloadsPath"], exist_ok=True)
+    if adopt and not store.shared:
+        await artifacts.adopt()
     while True:
         try:
-        for f in os.listdir(conf["downloadsPath"]):
-            fmt = datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(conf["downloadsPath"], f)))
-            if (datetime.datetime.now() - fmt).total_seconds() > 7200:
-                os.remove(os.path.join(conf["downloadsPath"], f))
-        except FileNotFoundError:
-            os.makedirs(conf["downloadsPath"])
-        print("Cleaned!")
-        await asyncio.sleep(3600)
+            removed = await artifacts.sweep()
+            if removed > 0:
+                print(f"Cleaned {removed} files!")
+            await jobState.prune()
+        except Exception as e:
+            capture_exception(e)
+        await asyncio.sleep(conf.get("cleanInterval", 60))
+
+class DownloadHandler(tornado.web.StaticFileHandler):
+    """
+    Static file handler for downloads that counts the bytes it sends, with range and conditional requests
+    File names are unique so files are cached for good and their ETag comes from their size and modification time
+    instead of hashing the whole file
+    With sendfile set the front end server is told to send the file itself with an X-Sendfile or X-Accel-Redirect header
+    so the bytes never go through this process
+    """
+    async def get(self, path: str, include_body: bool = True):
+        # The store's journals and files that are still being written aren't downloads
+        if path.startswith(".") or "/." in path:
+            raise tornado.web.HTTPError(404)
+        # Downloads count as uses so files that are still popular are kept
+        artifacts.touch(path)
+        mode = conf.get("sendfile", False)
+        if mode == False:
+            await super().get(path, include_body)
+            return
+        # Same checks and headers as a normal download
+        self.path = self.parse_url_path(path)
+        self.absolute_path = self.validate_absolute_path(self.root, self.get_absolute_path(self.root, self.path))
+        if self.absolute_path == None:
+            return
+        self.modified = self.get_modified_time()
+        self.set_headers()
+        if self.should_return_304():
+            self.set_status(304)
+            return
+        # The front end takes care of ranges and HEAD requests
+        if mode == "x-accel-redirect":
+            self.set_header("X-Accel-Redirect", conf.get("sendfilePrefix", "/internal-downloads/") + urllib.parse.quote(self.path))
+        else:
+            self.set_header("X-Sendfile", self.absolute_path)
+        bytesServed.inc(self.get_content_size(), route="sendfile")
+
+    def compute_etag(self) -> str|None:
+        if not hasattr(self, "absolute_path"):
+            return None
+        stat = os.stat(self.absolute_path)
+        return f'"{stat.st_size:x}-{int(stat.st_mtime * 1000):x}"'
+
+    def get_cache_time(self, path: str, modified, mime_type: str) -> int:
+        return 365 * 24 * 3600
+
+    def set_extra_headers(self, path: str):
+        self.set_header("Cache-Control", f"public, max-age={365 * 24 * 3600}, immutable")
+
+    def write(self, chunk):
+        bytesServed.inc(len(chunk), route="downloads")
+        super().write(chunk)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Prometheus metrics
+    """
+    async def get(self):
+        # Some metrics are collected on the spot and may block, e.g. disk usage
+        body = await runJob("extract", renderMetrics)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(body)
 
 def make_app():
     return tornado.web.Application([
-        (r'/downloads/(.*)', tornado.web.StaticFileHandler, {'path': conf["downloadsPath"]}),
+        (r'/downloads/(.*)', DownloadHandler, {'path': conf["downloadsPath"]}),
+        (r'/playlists/(.*)\.zip', PlaylistZipHandler),
+        (r'/metrics', MetricsHandler),
         (r"/socket.io/", socketio.get_tornado_handler(sio))
     ])
 
+async def worker():
+    """
+    Worker main method, runs jobs from the job queue
+    Emits go back to the clients through the job queue
+    """
+    if jobQueue == None:
+        raise ValueError("jobQueue has to be configured to run a worker")
+    async def run(job: dict[str]):
+        await runAdmitted(job["name"], job["sid"], job["data"], job.get("client", job["sid"]), job.get("jobid"))
+    # Workers look after the files they make, the web instance adopts whatever is left over on restart
+    task = asyncio.create_task(clean(adopt=False))
+    task2 = asyncio.create_task(watchdog.run())
+    await asyncio.sleep(0)
+    print("Worker started!")
+    await jobQueue.consume(run, conf.get("workerConcurrency", 2))
+
 async def main():
     """
     Main method
@@ -570,10 +3480,23 @@ async def main():
     # Set up cleaning task
     task2 = asyncio.create_task(clean())
     await asyncio.sleep(0)
+    # Set up the event loop watchdog
+    task4 = asyncio.create_task(watchdog.run())
+    await asyncio.sleep(0)
+    # Run the jobs that were interrupted by a restart again, with a job queue the workers run the jobs and get them from the queue again instead
+    if jobQueue == None:
+        await jobState.recover()
+    # If jobs are sent to workers pass their events on to the clients
+    if jobQueue != None:
+        task3 = asyncio.create_task(jobQueue.relay())
+        await asyncio.sleep(0)
     # Generic tornado setup
     app = make_app()
     app.listen(conf["listeningPort"])
     await asyncio.Event().wait()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if isWorker:
+        asyncio.run(worker())
+    else:
+        asyncio.run(main())
\ No newline at end of file